@@ -0,0 +1,126 @@
+
+# Author: Matteo L. BEDINI
+# Date: April 2016
+
+###########################################################################
+##                         MULTI-CATALOG MODULE                          ##
+###########################################################################
+
+# Every catalog is processed by PortfolioProcessor in a thread of the same process: the XML
+# parsing of the catalogs overlaps, and the pricing configuration (loaded once), the interned
+# models (ModelFactory) and the grids/pdf weights (PricingMethods) are shared by all of them.
+
+import concurrent.futures
+import datetime
+import glob
+import os
+import time
+
+import PortfolioProcessor
+
+def BatchProcessor(catalogs, output_dir=".", snapshot_name=None, max_workers=None, checkpoint_name=None,
+                   pricing_configuration_name="pricing_configuration.json", workers=None):
+    """ Function BatchProcessor.
+    Input Argument: catalogs (string). A directory (every *.xml file in it is processed) or a glob pattern
+                    output_dir (string, optional). Directory of the logs, of the outputs and of the summary
+                    snapshot_name (string, optional). A snapshot passed to every PortfolioProcessor
+                    max_workers (int, optional). Number of catalogs processed at the same time
+                    checkpoint_name (string, optional). A checkpoint file shared by every PortfolioProcessor
+                    pricing_configuration_name (string, optional). Name of the JSON pricing configuration
+                    workers (int, optional). Number of pricing threads of every PortfolioProcessor (None: deal by deal)
+    Output: A dictionary {catalog name: list of deals} (None for the catalogs which could not be parsed).
+    For every catalog <name>.xml, <name>_log.txt and <name>_priced.xml are written in output_dir,
+    together with a combined batch_summary.txt (see output_stems when two catalogs have the same name).
+    """
+    assert isinstance(catalogs, str), "catalogs must be a string"
+    pattern = os.path.join(catalogs, "*.xml") if os.path.isdir(catalogs) else catalogs
+    filenames = sorted(glob.glob(pattern))
+    os.makedirs(output_dir, exist_ok=True)
+
+    summary_name = os.path.join(output_dir, "batch_summary.txt")
+    summary_header = "BatchProcessor SUMMARY: " + catalogs + " - " + datetime.datetime.now().isoformat() + "\n"
+    with open(summary_name, mode="w", encoding="utf-8") as f:
+        f.write(summary_header.upper())
+        f.write("%d catalogs found\n" % len(filenames))
+        pricing_configuration = PortfolioProcessor.load_pricing_configuration(pricing_configuration_name, f)
+
+    stems = output_stems(filenames)
+
+    def process(filename):
+        stem = stems[filename]
+        start = time.perf_counter()
+        portfolio = PortfolioProcessor.PortfolioProcessor(filename,
+                                                          snapshot_name=snapshot_name,
+                                                          log_name=os.path.join(output_dir, stem + "_log.txt"),
+                                                          pricing_configuration=pricing_configuration,
+                                                          output_name=os.path.join(output_dir, stem + "_priced.xml"),
+                                                          verbose=False,
+                                                          checkpoint_name=checkpoint_name,
+                                                          workers=workers)
+        return portfolio, time.perf_counter()-start
+
+    start = time.perf_counter()
+    results = dict()
+    elapsed = dict()
+    errors = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process, filename): filename for filename in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            filename = futures[future]
+            try:
+                results[filename], elapsed[filename] = future.result()
+            except Exception as err:
+                results[filename] = None
+                errors[filename] = err
+    total_elapsed = time.perf_counter()-start
+
+    with open(summary_name, mode="a", encoding="utf-8") as f:
+        for filename in filenames:
+            portfolio = results[filename]
+            if filename in errors:
+                f.write("A problem occurred while processing catalog " + filename + ": " + str(errors[filename].args) + "\n")
+            elif portfolio is None:
+                f.write(filename + ": could not be parsed (see its log)\n")
+            else:
+                n_priced = len([deal for deal in portfolio if hasattr(deal, "price")])
+                f.write("%s: %d deals loaded, %d priced in %.3f s\n" % (filename, len(portfolio), n_priced, elapsed[filename]))
+
+        loaded = [p for p in results.values() if p is not None]
+        f.write("\nTotal: %d catalogs, %d deals loaded, %d priced in %.3f s\n"
+                % (len(results), sum([len(p) for p in loaded]),
+                   sum([len([deal for deal in p if hasattr(deal, "price")]) for p in loaded]),
+                   total_elapsed))
+
+    return results
+
+
+def output_stems(filenames):
+    """ Function output_stems.
+    Input Argument: filenames (list). The catalogs of a batch
+    Output: A dictionary {catalog name: stem of its log and output}. The stem is the catalog name
+    without extension, unless several catalogs share it (e.g. desks/*/catalog.xml): their stems are
+    then their paths relative to the common directory (separators replaced by "_"), with an index
+    appended if it is still not enough.
+    """
+    names = [os.path.splitext(os.path.basename(filename))[0] for filename in filenames]
+    common_dir = os.path.commonpath([os.path.dirname(os.path.abspath(filename)) for filename in filenames]) if filenames else ""
+
+    stems = dict()
+    used = set()
+    for filename, name in zip(filenames, names):
+        stem = name
+        if names.count(name) > 1:
+            relative = os.path.relpath(os.path.splitext(os.path.abspath(filename))[0], common_dir)
+            stem = relative.replace(os.sep, "_")
+        unique_stem = stem
+        index = 1
+        while unique_stem in used:
+            index += 1
+            unique_stem = "%s_%d" % (stem, index)
+        used.add(unique_stem)
+        stems[filename] = unique_stem
+    return stems
+
+
+if __name__=="__main__":
+    BatchProcessor(".", output_dir="batch_output")
@@ -0,0 +1,91 @@
+
+# Author: Matteo L. BEDINI
+# Date: April 2016
+
+###########################################################################
+##                    CHECKPOINTS OF PRICING RUNS                        ##
+###########################################################################
+
+# Priced deals are saved in a local SQLite file, in batches (one transaction every batch_size
+# deals). A run is identified by a key built from the catalog content, the settings, the pricing
+# configuration and the engine version: restarting the same run skips the deals already priced,
+# while any change in the inputs starts a brand new run.
+
+import hashlib
+import json
+import sqlite3
+
+import PricingMethods
+
+def run_key(filename, settings, pricing_configuration):
+    """ function run_key
+
+    input: filename: the name of the XML catalog
+           settings: the grid settings
+           pricing_configuration: the pricing configuration
+    output: a string identifying the run
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        digest.update(f.read())
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    digest.update(json.dumps(pricing_configuration, sort_keys=True).encode("utf-8"))
+    digest.update(PricingMethods.ENGINE_VERSION.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class CheckpointStore:
+    """A Checkpoint Store Class.
+
+    Priced deals are identified by their position in the portfolio and by their ID.
+    Prices added to the store are kept in memory and written every batch_size deals
+    (and when the store is committed or closed).
+    """
+
+    def __init__(self, checkpoint_name, key, batch_size=500):
+        """ Checkpoint Store. Compulsory input arguments:
+            + checkpoint_name = the name of the SQLite file (created if needed)
+            + key = the run key (see run_key)
+        Optional input arguments:
+            + batch_size = a positive integer: the number of deals saved in a single transaction
+        """
+        assert isinstance(checkpoint_name, str), "checkpoint_name must be a string"
+        assert isinstance(batch_size, int) and batch_size>0, "batch_size must be a positive integer"
+        self.key = key
+        self.batch_size = batch_size
+        self.pending = list()
+        self.connection = sqlite3.connect(checkpoint_name, timeout=60.0)
+        # WAL + NORMAL: a commit does not wait for a full disk sync of the database
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS prices "
+                                "(run_key TEXT, position INTEGER, deal_id TEXT, price REAL, "
+                                "PRIMARY KEY (run_key, position))")
+        self.connection.commit()
+
+    def priced(self):
+        """ Dictionary {(position, deal ID): price} of the deals already saved for this run.
+        """
+        rows = self.connection.execute("SELECT position, deal_id, price FROM prices WHERE run_key=?", (self.key,))
+        return {(position, deal_id): price for position, deal_id, price in rows}
+
+    def add(self, position, deal_id, price):
+        """ Save the price of a deal (the batch is written once it is full).
+        """
+        self.pending.append((self.key, position, deal_id, price))
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        """ Write the pending prices.
+        """
+        if self.pending:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?)", self.pending)
+            self.pending = list()
+
+    def close(self):
+        """ Write the pending prices and close the store.
+        """
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,200 @@
+
+# Author: Matteo L. BEDINI
+# Date: April 2016
+
+###########################################################################
+##                   ACCURACY VS COST CONVERGENCE HARNESS                ##
+###########################################################################
+
+# Every engine is run at every resolution on a broad deterministic set of deals (every payoff
+# type on every model, see RoutingTuner.representative_deals). Each (engine, resolution) gives a
+# row of the convergence table: its largest and mean absolute error against the high-precision
+# reference, its nominal number of nodes and its pricing time per deal (caches warm).
+# Absolute times depend on the machine: every row also gives its time relative to a yardstick, a
+# fixed pure-Python loop used by no engine and timed in the same rounds as the engines
+# (relative_cost): this is what the envelope checks, so that any engine can be found slower.
+# The envelope keeps the rows of both vector_eval backends (with and without numpy).
+# The Pareto front keeps the rows for which no other row is both faster and more accurate.
+# An envelope (the rows recorded on a reference run) is used by PayoffTester to detect an
+# engine getting slower or less accurate.
+
+import json
+import os
+import time
+
+import DealDealer
+import PricingMethods
+import RoutingTuner
+
+# exact_eval is not listed: it depends on an Excel installation
+ENGINES = ["grid_eval", "vector_eval", "simpson_eval"]
+STEPS = [1.0, 0.5, 0.25, 0.1, 0.05]
+X_MIN = 0.01
+X_MAX = 100.01
+
+# the number of timed rounds (the fastest is kept) and the size of the yardstick loop
+REPEAT = 5
+YARDSTICK_NODES = 20000
+
+ENVELOPE_NAME = "convergence_envelope.json"
+
+def harness_deals():
+    """ The deterministic set of deals: the representative deals of every (payoff type, model) cell.
+    """
+    deals = list()
+    for payoff_type in ["PlainVanilla", "Digital", "Barrier"]:
+        for model_name in sorted(RoutingTuner.MODEL_SAMPLES):
+            deals += RoutingTuner.representative_deals(payoff_type, model_name)
+    return deals
+
+
+def node_count(settings):
+    """ Nominal number of nodes of a grid (the Simpson rule adds at most a few nodes per breakpoint).
+    """
+    x_min, x_step, x_max = PricingMethods.settings_key(settings)
+    return int((x_max-x_min)/x_step) + 1
+
+
+def convergence_table(engines=ENGINES, steps=STEPS, deals=None):
+    """ function convergence_table
+
+    input: engines: the names of the pricing methods
+           steps: the grid steps (the resolutions)
+           deals: the deals (harness_deals() if None)
+    output: a list of rows (dictionaries) with keys method, x_step, nodes, max_error, mean_error,
+            seconds_per_deal, relative_cost (the time divided by the yardstick time) and numpy
+            (True if vector_eval could use numpy), sorted by method and decreasing step
+    """
+    if deals is None:
+        deals = harness_deals()
+    references = RoutingTuner.reference_prices(deals)
+
+    rows = list()
+    for settings in RoutingTuner.candidate_settings(steps, X_MIN, X_MAX):
+        step_rows = dict()
+        for pricing_method in engines:
+            result = RoutingTuner.benchmark(deals, references, pricing_method, settings)
+            errors = [abs(deal.price-reference) for deal, reference in zip(deals, references)]
+            step_rows[pricing_method] = {"method": pricing_method,
+                                         "x_step": settings["x_step"],
+                                         "nodes": node_count(settings),
+                                         "max_error": result["max_error"],
+                                         "mean_error": sum(errors)/len(errors),
+                                         "numpy": PricingMethods.numpy is not None}
+        seconds, yardstick = warm_seconds_per_deal(deals, engines, settings)
+        for pricing_method, row in step_rows.items():
+            row["seconds_per_deal"] = seconds[pricing_method]
+            row["relative_cost"] = seconds[pricing_method]/yardstick
+        rows += step_rows.values()
+    return sorted(rows, key=lambda r: (list(engines).index(r["method"]), -r["x_step"]))
+
+
+def yardstick():
+    """ The yardstick of the timings: a fixed pure-Python loop (a trapezoidal sum of a call payoff
+    on YARDSTICK_NODES nodes, with its own weights) which no engine change can make slower or faster.
+    """
+    x = [0.01*i for i in range(YARDSTICK_NODES)]
+    w = [0.01]*YARDSTICK_NODES
+    def loop():
+        return sum([max(x_i-10.0, 0.0)*w_i for x_i, w_i in zip(x, w)])
+    return loop
+
+
+def warm_seconds_per_deal(deals, engines, settings, repeat=REPEAT):
+    """ function warm_seconds_per_deal
+
+    input: deals: a list of deals
+           engines: the names of the pricing methods
+           settings: the grid settings
+           repeat: the number of timed rounds
+    output: a dictionary {method: pricing time per deal} and the time of the yardstick loop.
+            The caches are primed first; every round times the yardstick and every engine in turn
+            (so that their ratios share the machine load) and the fastest round of each is kept
+    """
+    for pricing_method in engines:
+        for deal in deals:
+            DealDealer.deal_pricer(deal, pricing_method, settings)
+    loop = yardstick()
+    best_yardstick = float("inf")
+    best = {pricing_method: float("inf") for pricing_method in engines}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        loop()
+        best_yardstick = min(best_yardstick, time.perf_counter()-start)
+        for pricing_method in engines:
+            start = time.perf_counter()
+            for deal in deals:
+                DealDealer.deal_pricer(deal, pricing_method, settings)
+            best[pricing_method] = min(best[pricing_method], time.perf_counter()-start)
+    return {pricing_method: elapsed/len(deals) for pricing_method, elapsed in best.items()}, best_yardstick
+
+def pareto_front(rows):
+    """ The rows of a convergence table not dominated by another row (i.e. there is no row
+    at least as fast and as accurate, and strictly better on one of the two), sorted by time.
+    """
+    def dominates(r, s):
+        return (r["seconds_per_deal"] <= s["seconds_per_deal"] and r["max_error"] <= s["max_error"]
+                and (r["seconds_per_deal"] < s["seconds_per_deal"] or r["max_error"] < s["max_error"]))
+    front = [s for s in rows if not any([dominates(r, s) for r in rows])]
+    return sorted(front, key=lambda r: r["seconds_per_deal"])
+
+
+def write_report(rows, report_name):
+    """ Write the convergence table and its Pareto front as a text report.
+    """
+    line = "%-14s %8s %8s %12s %12s %14s\n"
+    with open(report_name, mode="w", encoding="utf-8") as f:
+        f.write("CONVERGENCE TABLE\n")
+        f.write(line % ("method", "x_step", "nodes", "max_error", "mean_error", "sec_per_deal"))
+        for r in rows:
+            f.write(line % (r["method"], "%g" % r["x_step"], r["nodes"], "%.3e" % r["max_error"],
+                            "%.3e" % r["mean_error"], "%.3e" % r["seconds_per_deal"]))
+        f.write("\nPARETO FRONT (fastest first)\n")
+        f.write(line % ("method", "x_step", "nodes", "max_error", "mean_error", "sec_per_deal"))
+        for r in pareto_front(rows):
+            f.write(line % (r["method"], "%g" % r["x_step"], r["nodes"], "%.3e" % r["max_error"],
+                            "%.3e" % r["mean_error"], "%.3e" % r["seconds_per_deal"]))
+
+
+def record_envelope(rows, envelope_name=ENVELOPE_NAME):
+    """ Save the rows of a convergence table as the envelope the engines must stay in. The rows
+    recorded with the other vector_eval backend (numpy or not) are kept.
+    """
+    recorded = dict()
+    if os.path.exists(envelope_name):
+        recorded = load_envelope(envelope_name)
+    recorded.update({envelope_key(r): r for r in rows})
+    with open(envelope_name, mode="w", encoding="utf-8") as f:
+        json.dump(sorted(recorded.values(), key=lambda r: (not r["numpy"], ENGINES.index(r["method"]), -r["x_step"])), f, indent=4)
+
+
+def envelope_key(row):
+    """ The (method, x_step, numpy) key of a row in the envelope.
+    """
+    return (row["method"], row["x_step"], row["numpy"])
+
+
+def load_envelope(envelope_name=ENVELOPE_NAME):
+    """ Dictionary {(method, x_step, numpy): recorded row}.
+    """
+    with open(envelope_name, mode="r", encoding="utf-8") as f:
+        return {envelope_key(r): r for r in json.load(f)}
+
+def median_table(tables):
+    """ The convergence table whose times (seconds_per_deal and relative_cost) are the medians of the
+    ones of several tables with the same rows (e.g. several runs of convergence_table).
+    """
+    rows = list()
+    for same_rows in zip(*tables):
+        row = dict(same_rows[0])
+        for key in ["seconds_per_deal", "relative_cost"]:
+            row[key] = sorted([r[key] for r in same_rows])[len(same_rows)//2]
+        rows.append(row)
+    return rows
+
+
+if __name__=="__main__":
+    # the envelope is recorded on the median of a few runs: a single run may be unlucky
+    rows = median_table([convergence_table() for _ in range(5)])
+    write_report(rows, "convergence_report.txt")
+    record_envelope(rows)
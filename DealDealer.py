@@ -2,6 +2,8 @@
 # Author: Matteo L. BEDINI
 # Date: April 2016
 
+import math
+
 import PricingMethods
 
 
@@ -16,4 +18,24 @@ def deal_pricer(payoff, pricing_method, settings):
     
     price = pricing_fun(payoff, settings)
     #print(price)
+    assert math.isfinite(price), "the price is not a finite number: " + str(price)
     payoff.price = price
+
+
+def batch_pricer(payoffs, pricing_method, settings):
+    """batch_pricer
+    input: a list of payoffs sharing type and model, a pricing method, pricing settings
+    this functions compute the prices of the payoffs and add them to their
+    instance attributes: methods with a batch version (e.g. vector_eval_batch)
+    price them at once, the others one by one
+    """
+    batch_fun = getattr(PricingMethods, pricing_method + "_batch", None)
+    if batch_fun is None:
+        for payoff in payoffs:
+            deal_pricer(payoff, pricing_method, settings)
+        return
+
+    prices = batch_fun(payoffs, settings)
+    assert all([math.isfinite(price) for price in prices]), "some prices are not finite numbers"
+    for payoff, price in zip(payoffs, prices):
+        payoff.price = price
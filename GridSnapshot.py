@@ -0,0 +1,153 @@
+
+# Author: Matteo L. BEDINI
+# Date: April 2016
+
+###########################################################################
+##                  SNAPSHOT OF PRECOMPUTED PRICING TABLES               ##
+###########################################################################
+
+# A snapshot file is made of:
+#   - the magic string MAGIC
+#   - the length of the header (8 bytes, little endian)
+#   - the header: a JSON dictionary with the engine version, the settings, the byte order,
+#     the number of grid nodes and the offset (in doubles) of every weight table
+#   - some padding, then the tables themselves as raw doubles
+# Loading memory-maps the file read-only: the tables are never copied, so many processes
+# loading the same snapshot share the same pages.
+
+import array
+import json
+import mmap
+import os
+import sys
+import tempfile
+import threading
+
+import PricingMethods
+
+MAGIC = b"PYRSNAP1"
+
+# mapped files must stay open as long as their tables are used by PricingMethods.
+# {(device, inode, size, modification time): mapping}: loading the same file again reuses its mapping
+_mapped_files = dict()
+_lock = threading.Lock()
+
+def export_snapshot(snapshot_name, settings, models=None):
+    """ function export_snapshot
+
+    input: snapshot_name: the name of the snapshot file to be written
+           settings: the grid settings
+           models: an iterable of (name, location, scale) tuples (e.g. [deal.model for deal in portfolio]).
+                   If None, every table already cached by PricingMethods for settings is exported
+    output: the number of weight tables written
+    """
+    assert isinstance(snapshot_name, str), "snapshot_name must be a string"
+
+    grid = PricingMethods.get_grid(settings)
+    if models is None:
+        weights = PricingMethods.cached_weights(settings)
+    else:
+        weights = {tuple(m): PricingMethods.get_pdf_weights(m, settings) for m in models}
+
+    item_size = array.array("d").itemsize
+    offset = 0
+    tables = list()
+    for model in weights:
+        offset += len(grid)
+        tables.append([model[0], model[1], model[2], offset])
+    header = {"engine_version": PricingMethods.ENGINE_VERSION,
+              "settings": list(PricingMethods.settings_key(settings)),
+              "byteorder": sys.byteorder,
+              "length": len(grid),
+              "tables": tables}
+    raw_header = json.dumps(header).encode("utf-8")
+    data_start = len(MAGIC) + 8 + len(raw_header)
+    padding = -data_start % item_size
+
+    # the snapshot may be memory-mapped by running processes: it is never rewritten in place.
+    # A new file is written next to it and renamed over it, readers keep the old (unlinked) file
+    directory = os.path.dirname(os.path.abspath(snapshot_name))
+    fd, tmp_name = tempfile.mkstemp(dir=directory, prefix=os.path.basename(snapshot_name) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(raw_header).to_bytes(8, "little"))
+            f.write(raw_header)
+            f.write(b"\0" * padding)
+            f.write(array.array("d", grid).tobytes())
+            for w in weights.values():
+                f.write(array.array("d", w).tobytes())
+        os.replace(tmp_name, snapshot_name)
+    except:
+        os.remove(tmp_name)
+        raise
+
+    return len(tables)
+
+
+def read_header(snapshot_name):
+    """ Header (a dictionary) of a snapshot file. A ValueError is raised if the file is not a snapshot.
+    """
+    with open(snapshot_name, "rb") as f:
+        return _read_header(f)[0]
+
+
+def _read_header(f):
+    # output: the header and the (aligned) position of the first double
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f.name + " is not a pricing snapshot")
+    header_length = int.from_bytes(f.read(8), "little")
+    header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = len(MAGIC) + 8 + header_length
+    data_start += -data_start % array.array("d").itemsize
+    return header, data_start
+
+
+def is_stale(header, settings):
+    """ True if a snapshot header does not match the settings or the running engine.
+    """
+    return (header["engine_version"] != PricingMethods.ENGINE_VERSION
+            or header["byteorder"] != sys.byteorder
+            or tuple(header["settings"]) != PricingMethods.settings_key(settings))
+
+
+def load_snapshot(snapshot_name, settings):
+    """ function load_snapshot
+
+    input: snapshot_name: the name of a snapshot file written by export_snapshot
+           settings: the grid settings of the coming pricing
+    output: the number of weight tables made available to PricingMethods
+            (0 if the snapshot is stale, i.e. built with other settings or another engine version).
+            A file already loaded (and not replaced since) is not mapped again
+    """
+    with open(snapshot_name, "rb") as f:
+        header, data_start = _read_header(f) # a ValueError may be launched if the file is not a snapshot
+        if is_stale(header, settings):
+            return 0
+        # a snapshot replaced by export_snapshot is a new file: it gets a new mapping
+        stat = os.fstat(f.fileno())
+        file_key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with _lock:
+            mapped = _mapped_files.get(file_key)
+            if mapped is None:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                _mapped_files[file_key] = mapped
+
+    length = header["length"]
+    doubles = memoryview(mapped)[data_start:].cast("d")
+
+    grid = doubles[:length]
+    weights = {(name, location, scale): doubles[offset:offset+length]
+               for name, location, scale, offset in header["tables"]}
+    PricingMethods.register_tables(settings, grid, weights)
+
+    return len(weights)
+
+
+def release_snapshots():
+    """ Drop the PricingMethods caches and unmap every loaded snapshot.
+    """
+    PricingMethods.clear_caches()
+    with _lock:
+        while _mapped_files:
+            _mapped_files.popitem()[1].close()
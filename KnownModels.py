@@ -15,6 +15,16 @@ class RecognizedPDF:
         assert (isinstance(scale,int) or isinstance(scale, float)) and scale>0, "scale must be a positive number"
         self.location = location
         self.scale = scale
+        self._precompute()
+
+    def _precompute(self):
+        """ Hook for the constants which only depend on location and scale:
+        they are computed once at construction instead of at every pdf call.
+        """
+        self.log_normalizer = 0.0
+
+    def log_pdf(self, x):
+        pass
 
     def pdf(self, x):
         pass
@@ -26,6 +36,17 @@ class RecognizedPDF:
 
 class GammaPDF(RecognizedPDF):    
 
+    def _precompute(self):
+        # log(Gamma(k)*theta^k): lgamma does not overflow for large shape parameters
+        self.log_normalizer = math.lgamma(self.location) + self.location*math.log(self.scale)
+        self.normalizer = math.exp(-self.log_normalizer)
+
+    def log_pdf(self, x):
+        """ Logarithm of the Gamma probability density function evaluated at x (x>0).
+        """
+        assert 0<x, "x must be strictly positive"
+        return (self.location-1)*math.log(x) - x/self.scale - self.log_normalizer
+
     def pdf(self, x):
         """ Gamma probability density function evaluated at x.
             (see, e.g., https://en.wikipedia.org/wiki/Gamma_distribution)
@@ -39,7 +60,12 @@ class GammaPDF(RecognizedPDF):
             + The Gamma PDF evaluated at x.
         """
         assert 0<=x, "x must be positive"
-        return pow(x,self.location-1)*math.exp(-x/self.scale)/(math.gamma(self.location)*pow(self.scale, self.location))
+        if x==0:
+            # the density in 0 is finite only for location>=1 (pow(0, location-1) fails otherwise)
+            if self.location<1:
+                raise ZeroDivisionError("the Gamma density is infinite in 0 for location<1")
+            return 0.0 if self.location>1 else self.normalizer
+        return math.exp(self.log_pdf(x))
 
 
 ###########################################################################
@@ -51,6 +77,19 @@ class LogNormalPDF(RecognizedPDF):
     x_min = 1.e-5
     x_tol = 1.e-5
 
+    def _precompute(self):
+        self.normalizer = self.scale*math.sqrt(2*math.pi)
+        self.log_normalizer = math.log(self.normalizer)
+        self.two_var = 2*self.scale**2
+
+    def log_pdf(self, x):
+        """ Logarithm of the Lognormal probability density function evaluated at x.
+        """
+        assert 0<=x, "x must be positive"
+        y = LogNormalPDF.x_min if x-LogNormalPDF.x_min<=LogNormalPDF.x_tol else x # if we are too close to 0 round to x_min
+        log_y = math.log(y)
+        return -pow(log_y-self.location,2)/self.two_var - log_y - self.log_normalizer
+
     def pdf(self, x):
         """ Lognormal probability density function evaluated at x.
             (see, e.g., https://en.wikipedia.org/wiki/Log-normal_distribution)
@@ -64,8 +103,8 @@ class LogNormalPDF(RecognizedPDF):
             + The Lognormal PDF evaluated at x.
         """
         assert 0<=x, "x must be positive"
-        y = x_min if abs(x-LogNormalPDF.x_min)<=LogNormalPDF.x_tol else x # if we are too close to 0 round to x_min
-        return math.exp(-pow(math.log(y)-self.location,2)/(2*self.scale**2)) / (y*self.scale*math.sqrt(2*math.pi))
+        y = LogNormalPDF.x_min if x-LogNormalPDF.x_min<=LogNormalPDF.x_tol else x # if we are too close to 0 round to x_min
+        return math.exp(-pow(math.log(y)-self.location,2)/self.two_var) / (y*self.normalizer)
 
 
 ###########################################################################
@@ -74,6 +113,18 @@ class LogNormalPDF(RecognizedPDF):
 
 class UniformPDF(RecognizedPDF):    
 
+    def _precompute(self):
+        self.a = self.location-math.sqrt(3*self.scale)
+        self.b = self.location+math.sqrt(3*self.scale)
+        self.density = 1 / (self.b - self.a)
+        self.log_normalizer = math.log(self.b - self.a)
+
+    def log_pdf(self, x):
+        """ Logarithm of the Uniform probability density function evaluated at x.
+        """
+        assert 0<=x, "Invalid input value for x"
+        return -self.log_normalizer if self.a<= x <=self.b else -math.inf
+
     def pdf(self, x):
         """ Uniform probability density function evaluated at x.
             (see, e.g., https://en.wikipedia.org/wiki/Uniform_distribution_(continuous))
@@ -87,9 +138,7 @@ class UniformPDF(RecognizedPDF):
             + The Uniform PDF evaluated at x.
         """
         assert 0<=x, "Invalid input value for x"
-        a = self.location-math.sqrt(3*self.scale)
-        b = self.location+math.sqrt(3*self.scale)
-        return 1 / (b -a) if a<= x <=b else 0.0
+        return self.density if self.a<= x <=self.b else 0.0
     
 
     
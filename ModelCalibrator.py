@@ -0,0 +1,171 @@
+
+# Author: Matteo L. BEDINI
+# Date: April 2016
+
+###########################################################################
+##                 CALIBRATION OF MODEL LOCATION/SCALE                   ##
+###########################################################################
+
+# The grid price of a payoff is sum_n f(x_n)*w_n(location, scale): the payoff values f(x_n) do not
+# depend on the model, so they are computed once for every quote. Each iteration then builds one
+# weight vector per trial model and prices all the quotes with it (a batch of dot products), the
+# gradient being obtained with central bumps of the same batch.
+# The solver is a Levenberg-Marquardt on (log(location), log(scale)): both stay positive.
+
+from collections import namedtuple
+import math
+import xml.etree.ElementTree as etree
+
+import DerivativePayoff
+import KnownModels
+import PricingMethods
+
+Calibration = namedtuple("Calibration", ['model', 'residuals', 'iterations', 'converged'])
+
+# quotes of these payoff types can be calibrated on
+calibrable_payoffs = (DerivativePayoff.PlainVanilla, DerivativePayoff.Digital)
+
+def calibrate(quotes, model_name, location, scale, settings, max_iter=100, tol=1.e-10, bump=None, residual_tol=1.e-6):
+    """ function calibrate
+
+    input: quotes: a list of (payoff, quoted price) tuples (PlainVanilla or Digital payoffs)
+           model_name: a string of a model name (e.g. "Gamma")
+           location, scale: the starting point of the solver
+           settings: the grid settings used for pricing
+           max_iter: the maximum number of iterations
+           tol: the solver stops when the (relative) improvement of the parameters is below tol
+           bump: the bump size (on the log of the parameters) for the gradient. If None, each parameter
+                 is bumped enough to move the mean or the spread of the model by one grid step: grid prices
+                 are only piecewise smooth in the parameters, and smaller bumps see a wrong slope
+           residual_tol: the largest absolute residual accepted for a solver which could not improve anymore
+    output: a Calibration namedtuple: the calibrated model (a SimplePayoff.Model), the residuals
+            (model price - quoted price), the number of iterations and whether the solver converged
+            (i.e. the parameters stopped moving at a least-squares minimum, or the residuals are below residual_tol)
+    """
+    assert len(quotes)>0, "at least one quote is needed"
+    for payoff, quote in quotes:
+        assert isinstance(payoff, calibrable_payoffs), "only PlainVanilla and Digital quotes can be calibrated"
+        assert isinstance(quote, int) or isinstance(quote, float), "quoted prices must be numbers"
+    assert (isinstance(location,int) or isinstance(location, float)) and location>0, "location must be a positive number"
+    assert (isinstance(scale,int) or isinstance(scale, float)) and scale>0, "scale must be a positive number"
+    model_type = getattr(KnownModels, model_name + "PDF") # an AttributeError may be launched if model_name is not valid
+
+    x = PricingMethods.get_grid(settings)
+    x_step = PricingMethods.settings_key(settings)[1]
+    # payoff values on the grid, only the non-zero ones are kept
+    rows = list()
+    for payoff, quote in quotes:
+        rows.append([(i, f_i) for i, f_i in enumerate(map(payoff.payoff_function, x)) if f_i!=0.0])
+    quoted = [quote for payoff, quote in quotes]
+
+    def residuals(u):
+        w = _weights(model_type, math.exp(u[0]), math.exp(u[1]), x, x_step)
+        return [sum([f_i*w[i] for i, f_i in row]) - q for row, q in zip(rows, quoted)]
+
+    def moments(u):
+        w = _weights(model_type, math.exp(u[0]), math.exp(u[1]), x, x_step)
+        mass = sum(w)
+        mean = sum([x_i*w_i for x_i, w_i in zip(x, w)])/mass
+        spread = math.sqrt(max(sum([x_i*x_i*w_i for x_i, w_i in zip(x, w)])/mass - mean*mean, 0.0))
+        return mean, spread
+
+    def bump_size(u, j):
+        # the bump moving the mean or the spread of the model by about one grid step (at least 1.e-5),
+        # measured with a large probe: it sees the grid nodes crossed by the pdf
+        probe = 0.05
+        u_up = list(u)
+        u_down = list(u)
+        u_up[j] += probe
+        u_down[j] -= probe
+        (mean_up, spread_up), (mean_down, spread_down) = moments(u_up), moments(u_down)
+        slope = max(abs(mean_up-mean_down), abs(spread_up-spread_down))/(2*probe)
+        return min(max(x_step/slope, 1.e-5), 0.5) if slope>0.0 else 0.5
+
+    def jacobian(u):
+        columns = list()
+        for j in range(2):
+            h = bump if bump is not None else bump_size(u, j)
+            u_up = list(u)
+            u_down = list(u)
+            u_up[j] += h
+            u_down[j] -= h
+            columns.append([(r_up-r_down)/(2*h) for r_up, r_down in zip(residuals(u_up), residuals(u_down))])
+        return columns
+
+    u = [math.log(location), math.log(scale)]
+    r = residuals(u)
+    cost = sum([r_k*r_k for r_k in r])
+    damping = 1.e-3
+    iterations = 0
+    stalled = False
+
+    while iterations < max_iter and cost > 0.0:
+        iterations += 1
+        j_0, j_1 = jacobian(u)
+        # normal equations (J^T J + damping*diag(J^T J)) delta = -J^T r
+        a_00 = sum([v*v for v in j_0])
+        a_01 = sum([v*w for v, w in zip(j_0, j_1)])
+        a_11 = sum([w*w for w in j_1])
+        g_0 = sum([v*r_k for v, r_k in zip(j_0, r)])
+        g_1 = sum([w*r_k for w, r_k in zip(j_1, r)])
+
+        improved = False
+        while not improved and damping < 1.e12:
+            b_00 = a_00*(1+damping)
+            b_11 = a_11*(1+damping)
+            det = b_00*b_11 - a_01*a_01
+            if det<=0.0:
+                damping *= 10
+                continue
+            delta = [(-g_0*b_11 + g_1*a_01)/det, (-g_1*b_00 + g_0*a_01)/det]
+            u_new = [u[0]+delta[0], u[1]+delta[1]]
+            try:
+                r_new = residuals(u_new)
+                cost_new = sum([r_k*r_k for r_k in r_new])
+            except (AssertionError, ArithmeticError): # the step went out of the admissible parameters
+                cost_new = math.inf
+            if cost_new < cost:
+                improved = True
+                u, r, cost = u_new, r_new, cost_new
+                damping = max(damping/10, 1.e-12)
+            else:
+                damping *= 10
+
+        if not improved:
+            stalled = True
+            break
+        if max(abs(delta[0]), abs(delta[1])) < tol:
+            # the parameters stopped moving: it is a least-squares minimum only if the residuals are
+            # (nearly) orthogonal to the jacobian, otherwise the solver is stuck on a kink of the grid prices
+            stalled = math.sqrt(g_0*g_0 + g_1*g_1) > 1.e-3*math.sqrt((a_00 + a_11)*cost)
+            break
+    else:
+        # max_iter reached (a perfect fit, cost==0, exits the loop as converged)
+        stalled = cost > 0.0
+
+    model = DerivativePayoff.SimplePayoff.Model(model_name, math.exp(u[0]), math.exp(u[1]))
+    converged = not stalled or max([abs(r_k) for r_k in r]) <= residual_tol
+    return Calibration(model, r, iterations, converged)
+
+
+def _weights(model_type, location, scale, x, x_step):
+    # trapezoidal weights of a trial model (not interned nor cached: trial models are thrown away)
+    pdf = model_type(location, scale).pdf
+    w = [pdf(x_i)*x_step for x_i in x]
+    w[0] *= 0.5
+    w[-1] *= 0.5
+    return w
+
+
+def model_block(calibration):
+    """ function model_block
+
+    input: a Calibration (an AssertionError is launched if it did not converge)
+    output: the XML <model> element to be pasted in a payoff of the catalog
+    """
+    assert calibration.converged, "the calibration did not converge: its model cannot be used"
+    model = calibration.model
+    block = etree.Element("model", distribution=model.name)
+    etree.SubElement(block, "location").text = repr(model.location)
+    etree.SubElement(block, "scale").text = repr(model.scale)
+    return etree.tostring(block, encoding="unicode")
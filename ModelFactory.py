@@ -2,8 +2,18 @@
 # Author: Matteo L. BEDINI
 # Date: April 2016
 
+import collections
+import threading
+
 import KnownModels
 
+# models are immutable once built: the same (name, location, scale) gives back the same instance.
+# Least recently used first: beyond MAX_INTERNED_MODELS the oldest models are dropped
+_interned_models = collections.OrderedDict()
+_lock = threading.Lock()
+
+MAX_INTERNED_MODELS = 1024
+
 def ModelFactory(model_name, location, scale):
     """ function ModelFactory
 
@@ -11,15 +21,33 @@ def ModelFactory(model_name, location, scale):
            location: the location parameter of the distribution
            scale: the scale parameter of the distribution
            
-    output: a known model
+    output: a known model (interned: the instance is shared by every caller asking for the same parameters,
+            as long as it is among the MAX_INTERNED_MODELS most recently used)
     """
 
     assert isinstance(model_name, str), "model_name must be a string"
     assert (isinstance(location,int) or isinstance(location, float)) and location>0, "location must be a positive number"
     assert (isinstance(scale,int) or isinstance(scale, float)) and scale>0, "scale must be a positive number"  
     
-    this_model = None
-    model_type = getattr(KnownModels,model_name) # an AttributeError may be launched if model_name is not valid
-    this_model = model_type(location, scale) #an AssertionError may be launched if the type/value of the parameters is not correct
+    key = (model_name, location, scale)
+    with _lock:
+        this_model = _interned_models.get(key)
+        if this_model is not None:
+            _interned_models.move_to_end(key)
+    if this_model is None:
+        model_type = getattr(KnownModels,model_name) # an AttributeError may be launched if model_name is not valid
+        this_model = model_type(location, scale) #an AssertionError may be launched if the type/value of the parameters is not correct
+        with _lock:
+            this_model = _interned_models.setdefault(key, this_model)
+            _interned_models.move_to_end(key)
+            while len(_interned_models) > MAX_INTERNED_MODELS:
+                _interned_models.popitem(last=False)
     
     return this_model
+
+
+def clear_interned_models():
+    """ Drop every interned model (e.g. to release memory between two unrelated runs).
+    """
+    with _lock:
+        _interned_models.clear()
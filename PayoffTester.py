@@ -7,9 +7,24 @@
 ###########################################################################
 
 import unittest
+import json
+import os
+import shutil
+import tempfile
+import time
 
 import DealDealer
 import DerivativePayoff
+import KnownModels
+import ModelFactory
+import PricingMethods
+import GridSnapshot
+import ModelCalibrator
+import BatchProcessor
+import PortfolioProcessor
+import RoutingTuner
+import ConvergenceHarness
+import ThreadBenchmark
 
 # pricing configuration is the default one (grid_eval)
 pricing_config = ({
@@ -99,7 +114,7 @@ class KnownPayoffValues(unittest.TestCase):
         pric_meth = pricing_config["Barrier"]["model"][barrier_call_1.model.name]
         DealDealer.deal_pricer(barrier_call_1, pric_meth, settings)
 
-        self.assertAlmostEqual(barrier_call_1.price, known_price,2)
+        self.assertAlmostEqual(barrier_call_1.price, known_price,8)
 
 
     
@@ -124,6 +139,466 @@ class BadPVCallInput(unittest.TestCase):
 
 
 
+class KnownModelsChecks(unittest.TestCase):
+    ### TEST FOR MODEL INTERNING AND NORMALIZATION ###
+
+    def test_model_factory_interning(self):
+        """ModelFactory should give back the same instance for the same parameters"""
+        gamma_1 = ModelFactory.ModelFactory("GammaPDF", 9.0, 3.0)
+        gamma_2 = ModelFactory.ModelFactory("GammaPDF", 9.0, 3.0)
+        gamma_3 = ModelFactory.ModelFactory("GammaPDF", 9.0, 2.0)
+        self.assertIs(gamma_1, gamma_2)
+        self.assertIsNot(gamma_1, gamma_3)
+
+    def test_model_factory_bounded(self):
+        """ModelFactory should only keep the most recently used models"""
+        original_max = ModelFactory.MAX_INTERNED_MODELS
+        try:
+            ModelFactory.MAX_INTERNED_MODELS = 2
+            ModelFactory.clear_interned_models()
+            gamma_1 = ModelFactory.ModelFactory("GammaPDF", 9.0, 3.0)
+            for location in [1.0, 2.0, 3.0]:
+                ModelFactory.ModelFactory("GammaPDF", location, 3.0)
+            self.assertEqual(len(ModelFactory._interned_models), 2)
+            self.assertIsNot(ModelFactory.ModelFactory("GammaPDF", 9.0, 3.0), gamma_1)
+        finally:
+            ModelFactory.MAX_INTERNED_MODELS = original_max
+
+    def test_gamma_large_shape(self):
+        """GammaPDF should not overflow for large shape parameters"""
+        gamma = ModelFactory.ModelFactory("GammaPDF", 400.0, 0.25)
+        known_value = 0.079872 # mode of the density (math.gamma(400.0) alone would overflow)
+        self.assertAlmostEqual(gamma.pdf(99.75), known_value, 4)
+
+    def test_lognormal_close_to_zero(self):
+        """LogNormalPDF should round to x_min when too close to 0"""
+        lognormal = ModelFactory.ModelFactory("LogNormalPDF", 1.0, 0.5)
+        self.assertEqual(lognormal.pdf(0.0), lognormal.pdf(KnownModels.LogNormalPDF.x_min))
+
+    def test_gamma_infinite_in_zero(self):
+        """A deal whose Gamma density is infinite on the grid should fail, not get an infinite price"""
+        gamma = ModelFactory.ModelFactory("GammaPDF", 0.5, 2.0)
+        self.assertRaises(ZeroDivisionError, gamma.pdf, 0.0)
+        call = DerivativePayoff.PlainVanilla(5.0, 1, "Gamma", 0.5, 2.0)
+        self.assertRaises(ZeroDivisionError, DealDealer.deal_pricer, call, "grid_eval", {"x_min":0.0, "x_step":0.5, "x_max":100.0})
+        self.assertFalse(hasattr(call, "price"))
+
+class GridSnapshotChecks(unittest.TestCase):
+    ### TEST FOR SNAPSHOT EXPORT/LOAD ###
+
+    def test_snapshot_round_trip(self):
+        """A loaded snapshot should give back the same prices and detect other settings"""
+        pv_put_1 = DerivativePayoff.PlainVanilla(15.0,-1,"Gamma",9.0,3.0)
+        DealDealer.deal_pricer(pv_put_1, "grid_eval", settings)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_name = os.path.join(tmp_dir, "tables.snap")
+            self.assertEqual(GridSnapshot.export_snapshot(snapshot_name, settings, [pv_put_1.model]), 1)
+            PricingMethods.clear_caches()
+
+            other_settings = {"x_min":1.0, "x_step":0.25, "x_max":100.0}
+            self.assertEqual(GridSnapshot.load_snapshot(snapshot_name, other_settings), 0)
+            self.assertEqual(GridSnapshot.load_snapshot(snapshot_name, settings), 1)
+
+            self.assertEqual(PricingMethods.grid_eval(pv_put_1, settings), pv_put_1.price)
+            # loading the same file again (e.g. for every catalog of a batch) reuses its mapping
+            self.assertEqual(GridSnapshot.load_snapshot(snapshot_name, settings), 1)
+            self.assertEqual(len(GridSnapshot._mapped_files), 1)
+            GridSnapshot.release_snapshots()
+
+    def test_weights_cache_bounded(self):
+        """Only the most recently built tables should be cached, the snapshot tables being always kept"""
+        pv_put_1 = DerivativePayoff.PlainVanilla(15.0,-1,"Gamma",9.0,3.0)
+        original_max = PricingMethods.MAX_CACHED_TABLES
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_name = os.path.join(tmp_dir, "tables.snap")
+            GridSnapshot.export_snapshot(snapshot_name, settings, [pv_put_1.model])
+            PricingMethods.clear_caches()
+            try:
+                PricingMethods.MAX_CACHED_TABLES = 2
+                GridSnapshot.load_snapshot(snapshot_name, settings)
+                for location in [1.0, 2.0, 3.0, 4.0]:
+                    DealDealer.deal_pricer(DerivativePayoff.PlainVanilla(15.0,-1,"Gamma",location,3.0), "grid_eval", settings)
+                self.assertEqual(sorted(PricingMethods.cached_weights(settings)),
+                                 [("Gamma", 3.0, 3.0), ("Gamma", 4.0, 3.0), ("Gamma", 9.0, 3.0)])
+            finally:
+                PricingMethods.MAX_CACHED_TABLES = original_max
+                GridSnapshot.release_snapshots()
+
+    def test_snapshot_refresh_while_mapped(self):
+        """Exporting over a loaded snapshot should leave the mapped tables untouched"""
+        pv_put_1 = DerivativePayoff.PlainVanilla(15.0,-1,"Gamma",9.0,3.0)
+        DealDealer.deal_pricer(pv_put_1, "grid_eval", settings)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_name = os.path.join(tmp_dir, "tables.snap")
+            GridSnapshot.export_snapshot(snapshot_name, settings, [pv_put_1.model])
+            PricingMethods.clear_caches()
+            self.assertEqual(GridSnapshot.load_snapshot(snapshot_name, settings), 1)
+
+            # the refreshed snapshot has other tables at the offsets of the mapped ones
+            self.assertEqual(GridSnapshot.export_snapshot(snapshot_name, settings, [("Uniform",10.0,3.0), ("Gamma",2.0,5.0)]), 2)
+            self.assertEqual(PricingMethods.grid_eval(pv_put_1, settings), pv_put_1.price)
+            self.assertEqual(GridSnapshot.read_header(snapshot_name)["tables"][0][:3], ["Uniform", 10.0, 3.0])
+            self.assertEqual(len([name for name in os.listdir(tmp_dir) if name.endswith(".tmp")]), 0)
+            GridSnapshot.release_snapshots()
+
+
+class ModelCalibratorChecks(unittest.TestCase):
+    ### TEST FOR MODEL CALIBRATION ###
+
+    def quotes(self, model_name, location, scale):
+        quotes = list()
+        for strike in [5.0, 10.0, 15.0, 20.0]:
+            for payoff_type in [DerivativePayoff.PlainVanilla, DerivativePayoff.Digital]:
+                deal = payoff_type(strike,1,model_name,location,scale)
+                DealDealer.deal_pricer(deal, "grid_eval", settings)
+                quotes.append((deal, deal.price))
+        return quotes
+
+    def test_calibration_recovers_model(self):
+        """ModelCalibrator should recover the model used to build the quotes"""
+        calibration = ModelCalibrator.calibrate(self.quotes("Gamma",9.0,1.5), "Gamma", 5.0, 2.0, settings)
+
+        self.assertTrue(calibration.converged)
+        self.assertAlmostEqual(calibration.model.location, 9.0, 6)
+        self.assertAlmostEqual(calibration.model.scale, 1.5, 6)
+        self.assertTrue(ModelCalibrator.model_block(calibration).startswith('<model distribution="Gamma">'))
+
+    def test_calibration_lognormal(self):
+        """ModelCalibrator should recover a LogNormal model"""
+        calibration = ModelCalibrator.calibrate(self.quotes("LogNormal",2.0,0.4), "LogNormal", 1.5, 0.8, settings)
+
+        self.assertTrue(calibration.converged)
+        self.assertAlmostEqual(calibration.model.location, 2.0, 6)
+        self.assertAlmostEqual(calibration.model.scale, 0.4, 6)
+
+    def test_calibration_not_converged(self):
+        """A calibration stuck away from the quotes should be reported and have no model block"""
+        calibration = ModelCalibrator.calibrate(self.quotes("Uniform",10.0,3.0), "Uniform", 8.0, 2.0, settings)
+
+        self.assertFalse(calibration.converged)
+        self.assertGreater(max([abs(r) for r in calibration.residuals]), 1.e-6)
+        self.assertRaises(AssertionError, ModelCalibrator.model_block, calibration)
+
+
+
+class BatchProcessorChecks(unittest.TestCase):
+    ### TEST FOR MULTI-CATALOG RUNS ###
+
+    def test_batch_outputs(self):
+        """BatchProcessor should write one log and one output per catalog plus a summary"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for desk in ["desk1", "desk2"]:
+                shutil.copy("DerivativeCatalog.xml", os.path.join(tmp_dir, desk + ".xml"))
+            output_dir = os.path.join(tmp_dir, "output")
+
+            results = BatchProcessor.BatchProcessor(tmp_dir, output_dir=output_dir)
+
+            self.assertEqual(sorted(os.listdir(output_dir)), ["batch_summary.txt", "desk1_log.txt", "desk1_priced.xml",
+                                                              "desk2_log.txt", "desk2_priced.xml"])
+            self.assertEqual([len(portfolio) for portfolio in results.values()], [4, 4])
+
+    def test_batch_same_catalog_names(self):
+        """BatchProcessor should not mix the outputs of catalogs with the same name"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for desk in ["desk1", "desk2"]:
+                os.makedirs(os.path.join(tmp_dir, desk))
+                shutil.copy("DerivativeCatalog.xml", os.path.join(tmp_dir, desk, "catalog.xml"))
+            output_dir = os.path.join(tmp_dir, "output")
+
+            BatchProcessor.BatchProcessor(os.path.join(tmp_dir, "*", "catalog.xml"), output_dir=output_dir)
+
+            self.assertEqual(sorted(os.listdir(output_dir)), ["batch_summary.txt",
+                                                              "desk1_catalog_log.txt", "desk1_catalog_priced.xml",
+                                                              "desk2_catalog_log.txt", "desk2_catalog_priced.xml"])
+
+
+
+class CheckpointChecks(unittest.TestCase):
+    ### TEST FOR RESUMABLE RUNS ###
+
+    def test_restart_skips_priced_deals(self):
+        """A restarted run should take its prices from the checkpoint"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_name = os.path.join(tmp_dir, "log.txt")
+            checkpoint_name = os.path.join(tmp_dir, "checkpoint.db")
+            first_run = PortfolioProcessor.PortfolioProcessor("DerivativeCatalog.xml", log_name=log_name, verbose=False,
+                                                              checkpoint_name=checkpoint_name, checkpoint_batch=3)
+            second_run = PortfolioProcessor.PortfolioProcessor("DerivativeCatalog.xml", log_name=log_name, verbose=False,
+                                                               checkpoint_name=checkpoint_name)
+            with open(log_name, encoding="utf-8") as f:
+                log = f.read()
+
+        self.assertEqual([deal.price for deal in second_run], [deal.price for deal in first_run])
+        self.assertIn("4 deals already priced will be skipped", log)
+        self.assertNotIn("Pricing Method:", log)
+
+    def test_resume_interrupted_run(self):
+        """A run interrupted after one batch should restart from the committed deals"""
+        original_deal_pricer = DealDealer.deal_pricer
+        priced_ids = list()
+
+        def interrupted_deal_pricer(payoff, pricing_method, settings):
+            if len(priced_ids)==2:
+                raise KeyboardInterrupt
+            priced_ids.append(payoff.ID)
+            original_deal_pricer(payoff, pricing_method, settings)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_name = os.path.join(tmp_dir, "log.txt")
+            checkpoint_name = os.path.join(tmp_dir, "checkpoint.db")
+            try:
+                DealDealer.deal_pricer = interrupted_deal_pricer
+                self.assertRaises(KeyboardInterrupt, PortfolioProcessor.PortfolioProcessor, "DerivativeCatalog.xml",
+                                  log_name=log_name, verbose=False, checkpoint_name=checkpoint_name, checkpoint_batch=2)
+                first_ids = list(priced_ids)
+
+                def counting_deal_pricer(payoff, pricing_method, settings):
+                    priced_ids.append(payoff.ID)
+                    original_deal_pricer(payoff, pricing_method, settings)
+
+                priced_ids.clear()
+                DealDealer.deal_pricer = counting_deal_pricer
+                second_run = PortfolioProcessor.PortfolioProcessor("DerivativeCatalog.xml", log_name=log_name, verbose=False,
+                                                                   checkpoint_name=checkpoint_name)
+            finally:
+                DealDealer.deal_pricer = original_deal_pricer
+            with open(log_name, encoding="utf-8") as f:
+                log = f.read()
+
+        self.assertEqual(first_ids, ["1", "2"])
+        self.assertIn("2 deals already priced will be skipped", log)
+        self.assertEqual([line.split(" ")[1] for line in log.splitlines() if "restored from checkpoint" in line], ["1", "2"])
+        self.assertEqual(priced_ids, ["3", "4"])
+        self.assertEqual(len([deal for deal in second_run if hasattr(deal, "price")]), 4)
+
+    def test_checkpoint_cannot_be_opened(self):
+        """A checkpoint which cannot be opened should be logged and the deals priced anyway"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_name = os.path.join(tmp_dir, "log.txt")
+            portfolio = PortfolioProcessor.PortfolioProcessor("DerivativeCatalog.xml", log_name=log_name, verbose=False,
+                                                              checkpoint_name=tmp_dir) # a directory is not a database
+            with open(log_name, encoding="utf-8") as f:
+                log = f.read()
+
+        self.assertIn("A problem occurred while opening checkpoint", log)
+        self.assertEqual(len([deal for deal in portfolio if hasattr(deal, "price")]), 4)
+
+
+class RoutingTunerChecks(unittest.TestCase):
+    ### TEST FOR THE AUTO-TUNED ROUTES ###
+
+    def test_tuned_route_meets_target(self):
+        """RoutingTuner should pick a route meeting the accuracy target and PortfolioProcessor should follow it"""
+        base_configuration = {"Digital": {"strike": "", "model": {"LogNormal": "grid_eval"}}}
+        routing_table, report = RoutingTuner.tune(base_configuration, 1.e-4, RoutingTuner.candidate_settings([0.5, 0.05]))
+
+        route = routing_table["Digital"]["model"]["LogNormal"]
+        self.assertTrue(route["target_met"])
+        self.assertLessEqual(route["max_error"], 1.e-4)
+        self.assertEqual(len(report[("Digital", "LogNormal")]), 6)
+
+        self.assertEqual(route["validated_on"]["models"], [[2.0, 0.4]])
+        self.assertEqual(route["validated_on"]["strikes"], [6.0, 8.0, 10.0])
+
+        # only the step is tuned: the domain stays the one of the portfolio
+        digi_call_1 = DerivativePayoff.Digital(7.0,1,"LogNormal",2.0,0.4)
+        digi_call_1.type = "Digital"
+        self.assertEqual(PortfolioProcessor.get_pricing_route(routing_table, digi_call_1, settings),
+                         (route["method"], {"x_min":1.0, "x_step":route["settings"]["x_step"], "x_max":100.0}))
+
+    def test_tuned_route_keeps_catalog_domain(self):
+        """A deal whose mass lies beyond the tuning domain should be priced on the domain of its catalog"""
+        base_configuration = {"PlainVanilla": {"strike": "", "model": {"LogNormal": "grid_eval"}}}
+        routing_table, report = RoutingTuner.tune(base_configuration, 1.e-4, RoutingTuner.candidate_settings([0.5, 0.05]))
+        pv_call = DerivativePayoff.PlainVanilla(100.0,1,"LogNormal",5.0,0.4)
+        pv_call.type = "PlainVanilla"
+        catalog_settings = {"x_min":0.01, "x_step":0.5, "x_max":1000.01}
+
+        pricing_method, deal_settings = PortfolioProcessor.get_pricing_route(routing_table, pv_call, catalog_settings)
+        self.assertEqual(deal_settings["x_max"], 1000.01)
+        DealDealer.deal_pricer(pv_call, pricing_method, deal_settings)
+        self.assertAlmostEqual(pv_call.price, 63.66, 1)
+
+    def test_tune_on_portfolio(self):
+        """RoutingTuner should tune a cell on the deals of a portfolio, leaving their prices untouched"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            portfolio = PortfolioProcessor.PortfolioProcessor("DerivativeCatalog.xml", log_name=os.path.join(tmp_dir, "log.txt"),
+                                                              pricing_configuration=pricing_config, verbose=False)
+        prices = [deal.price for deal in portfolio]
+        routing_table, report = RoutingTuner.tune(pricing_config, 1.e-4, RoutingTuner.candidate_settings([0.5]), portfolio)
+
+        self.assertEqual([deal.price for deal in portfolio], prices)
+        self.assertEqual(sorted(report), [("Barrier", "LogNormal"), ("Digital", "LogNormal"), ("PlainVanilla", "Gamma"),
+                                          ("PlainVanilla", "Uniform")])
+        self.assertEqual(routing_table["PlainVanilla"]["model"]["Uniform"]["validated_on"]["models"], [[5.0, 2.0]])
+        self.assertEqual(routing_table["PlainVanilla"]["model"]["LogNormal"], "grid_eval") # no deal: not tuned
+
+    def test_benchmark_is_warm(self):
+        """The routing cost should be the warm cost per deal, the table build being reported apart"""
+        deals = RoutingTuner.representative_deals("PlainVanilla", "Gamma")
+        references = RoutingTuner.reference_prices(deals)
+        kept_deal = DerivativePayoff.PlainVanilla(15.0,-1,"Gamma",9.0,3.0)
+        DealDealer.deal_pricer(kept_deal, "grid_eval", settings)
+        kept_weights = PricingMethods.get_pdf_weights(kept_deal.model, settings)
+        original_build_pdf_weights = PricingMethods.build_pdf_weights
+
+        def slow_build_pdf_weights(model, settings, x):
+            time.sleep(0.2) # a build much slower than pricing the deals
+            return original_build_pdf_weights(model, settings, x)
+
+        try:
+            PricingMethods.build_pdf_weights = slow_build_pdf_weights
+            result = RoutingTuner.benchmark(deals, references, "grid_eval", settings)
+        finally:
+            PricingMethods.build_pdf_weights = original_build_pdf_weights
+
+        self.assertGreater(result["build_seconds"], 0.1)
+        self.assertLess(result["seconds_per_deal"]*len(deals), 0.1)
+        # the tables cached before the benchmark are still there
+        self.assertIs(PricingMethods.get_pdf_weights(kept_deal.model, settings), kept_weights)
+
+
+class ConvergenceEnvelope(unittest.TestCase):
+    ### TEST FOR ACCURACY AND COST OF EVERY ENGINE ###
+
+    # times are compared as ratios to a fixed pure-Python loop timed in the same run
+    # (relative_cost): an engine fails if its ratio gets this much larger than recorded
+    cost_slack = 2.0
+
+    @classmethod
+    def setUpClass(cls):
+        cls.rows = ConvergenceHarness.convergence_table()
+        cls.envelope = ConvergenceHarness.load_envelope()
+
+    def test_engines_accuracy(self):
+        """No engine should get less accurate than its recorded envelope"""
+        for row in self.rows:
+            recorded = self.envelope[ConvergenceHarness.envelope_key(row)]
+            self.assertLessEqual(row["max_error"], recorded["max_error"]*(1+1.e-6)+1.e-12, str(row))
+            self.assertLessEqual(row["mean_error"], recorded["mean_error"]*(1+1.e-6)+1.e-12, str(row))
+
+    def test_engines_cost(self):
+        """No engine should get slower, relative to the yardstick, than its recorded envelope"""
+        for row in self.rows:
+            recorded = self.envelope[ConvergenceHarness.envelope_key(row)]
+            self.assertLessEqual(row["relative_cost"], recorded["relative_cost"]*self.cost_slack, str(row))
+
+    def test_slower_grid_eval_detected(self):
+        """A grid_eval getting several times slower should leave its envelope"""
+        original_grid_eval = PricingMethods.grid_eval
+
+        def slow_grid_eval(payoff, settings):
+            for _ in range(3):
+                original_grid_eval(payoff, settings)
+            return original_grid_eval(payoff, settings)
+
+        deals = [deal for deal in ConvergenceHarness.harness_deals() if deal.model.name=="Gamma"]
+        try:
+            PricingMethods.grid_eval = slow_grid_eval
+            row = ConvergenceHarness.convergence_table(["grid_eval"], [0.1], deals)[0]
+        finally:
+            PricingMethods.grid_eval = original_grid_eval
+        recorded = self.envelope[ConvergenceHarness.envelope_key(row)]
+        self.assertGreater(row["relative_cost"], recorded["relative_cost"]*self.cost_slack)
+
+    def test_envelope_has_both_backends(self):
+        """The envelope should hold the rows of vector_eval with and without numpy"""
+        for use_numpy in [True, False]:
+            for x_step in ConvergenceHarness.STEPS:
+                self.assertIn(("vector_eval", x_step, use_numpy), self.envelope)
+
+    def test_pareto_front(self):
+        """The Pareto front should hold the most accurate and the fastest rows"""
+        front = ConvergenceHarness.pareto_front(self.rows)
+        self.assertIn(min(self.rows, key=lambda r: r["max_error"]), front)
+        self.assertIn(min(self.rows, key=lambda r: r["seconds_per_deal"]), front)
+
+class ThreadPoolChecks(unittest.TestCase):
+    ### TEST FOR THE THREAD-POOL PRICING PATH ###
+
+    def test_vector_eval_matches_grid_eval(self):
+        """vector_eval should give the grid_eval price (with or without numpy)"""
+        for deal in RoutingTuner.representative_deals("Barrier", "Gamma"):
+            self.assertAlmostEqual(PricingMethods.vector_eval(deal, settings), PricingMethods.grid_eval(deal, settings), 12)
+
+    def test_threads_match_serial(self):
+        """Pricing on a thread pool should give the serial prices, logged in the same order"""
+        vector_config = json.loads(json.dumps(pricing_config).replace("grid_eval", "vector_eval"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            serial_log = os.path.join(tmp_dir, "serial_log.txt")
+            threads_log = os.path.join(tmp_dir, "threads_log.txt")
+            serial_run = PortfolioProcessor.PortfolioProcessor("DerivativeCatalog.xml", log_name=serial_log,
+                                                               pricing_configuration=vector_config, verbose=False)
+            threads_run = PortfolioProcessor.PortfolioProcessor("DerivativeCatalog.xml", log_name=threads_log,
+                                                                pricing_configuration=vector_config, verbose=False,
+                                                                workers=4)
+            with open(serial_log, encoding="utf-8") as f:
+                serial_lines = [line for line in f if line.startswith("Deal: ")]
+            with open(threads_log, encoding="utf-8") as f:
+                threads_lines = [line for line in f if line.startswith("Deal: ")]
+
+        # the threads price batches with one numpy kernel: the sums may differ in the last bits
+        for threads_deal, serial_deal in zip(threads_run, serial_run):
+            self.assertAlmostEqual(threads_deal.price, serial_deal.price, 12)
+        self.assertEqual(threads_lines, serial_lines)
+
+    def test_vector_eval_batch_matches_grid_eval(self):
+        """A batch priced at once should give the grid_eval prices (with or without numpy)"""
+        for payoff_type in ["PlainVanilla", "Digital", "Barrier"]:
+            deals = RoutingTuner.representative_deals(payoff_type, "LogNormal")
+            for price, deal in zip(PricingMethods.vector_eval_batch(deals, settings), deals):
+                self.assertAlmostEqual(price, PricingMethods.grid_eval(deal, settings), 12)
+
+    def test_pricing_batches(self):
+        """Batches should hold deals of the same type, model and route, and be split among the threads"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            catalog_name = os.path.join(tmp_dir, "catalog.xml")
+            ThreadBenchmark.write_catalog(catalog_name, 90)
+            portfolio = PortfolioProcessor.PortfolioProcessor(catalog_name, log_name=os.path.join(tmp_dir, "log.txt"),
+                                                              pricing_configuration=pricing_config, verbose=False)
+        batches = PortfolioProcessor.get_pricing_batches(pricing_config, list(enumerate(portfolio)), settings, 2, 4)
+
+        self.assertEqual(sorted([position for batch in batches for position, deal in batch[2]]), list(range(90)))
+        for pricing_method, deal_settings, positioned_deals in batches:
+            self.assertLessEqual(len(positioned_deals), 4)
+            self.assertEqual(len(set([(deal.type, deal.model) for position, deal in positioned_deals])), 1)
+            self.assertEqual(pricing_method, PortfolioProcessor.get_pricing_route(pricing_config, positioned_deals[0][1], settings)[0]
+                             .replace("grid_eval", "vector_eval" if PricingMethods.numpy is not None else "grid_eval"))
+        # 9 cells of 10 deals: batches of at most 4 deals (4+4+2), or at least 4 batches for 4 threads (3+3+3+1)
+        self.assertEqual(len(batches), 9*3)
+        self.assertEqual(len(PortfolioProcessor.get_pricing_batches(pricing_config, list(enumerate(portfolio)), settings, 4)), 9*4)
+
+    def test_batches_on_calling_thread(self):
+        """Batches priced by the calling thread (workers=1) should give the prices of the thread pool"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            catalog_name = os.path.join(tmp_dir, "catalog.xml")
+            ThreadBenchmark.write_catalog(catalog_name, 90)
+            serial_seconds, serial_prices = ThreadBenchmark.time_pricing(catalog_name, 1)
+            threads_seconds, threads_prices = ThreadBenchmark.time_pricing(catalog_name, 4)
+        # the batches are cut according to the number of threads: the sums may differ in the last bits
+        for threads_price, serial_price in zip(threads_prices, serial_prices):
+            self.assertAlmostEqual(threads_price, serial_price, 12)
+
+    @unittest.skipIf(PricingMethods.numpy is None or (os.cpu_count() or 1) < 2,
+                     "the pricing threads need numpy and several cpus to run in parallel")
+    def test_threads_beat_serial(self):
+        """The same batches should be priced faster on a thread pool than by the calling thread alone"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            catalog_name = os.path.join(tmp_dir, "catalog.xml")
+            # a fine grid: the numpy kernels (which release the GIL) outweigh parsing and logging
+            ThreadBenchmark.write_catalog(catalog_name, 300, x_step=0.001)
+            ThreadBenchmark.time_pricing(catalog_name, 1) # priming run: the tables are built once
+            serial_seconds, serial_prices = ThreadBenchmark.time_pricing(catalog_name, 1, repeat=3)
+            threads_seconds, threads_prices = ThreadBenchmark.time_pricing(catalog_name, 4, repeat=3)
+
+        self.assertLess(threads_seconds, serial_seconds)
+        for threads_price, serial_price in zip(threads_prices, serial_prices):
+            self.assertAlmostEqual(threads_price, serial_price, 10)
+
+
+
 ########## HERE I COULD CONTINUE FOR TOO MUCH: THIS IS JUST A TINY POC! SO I'LL STOP TESTING HERE
    
 if __name__=="__main__":
@@ -7,23 +7,48 @@
 ###########################################################################
 
 import xml.etree.ElementTree as etree
+import concurrent.futures
 import datetime
 import json
 import os
+import sqlite3
 
 import PayoffFactory
 import DealDealer
+import GridSnapshot
+import CheckpointStore
+import PricingMethods
 
-def PortfolioProcessor(filename):
+# largest number of deals priced at once by a pricing thread (see get_pricing_batches)
+BATCH_SIZE = 256
+
+def PortfolioProcessor(filename, snapshot_name=None, log_name="log.txt", pricing_configuration=None, output_name=None, verbose=True,
+                       checkpoint_name=None, checkpoint_batch=500, pricing_configuration_name="pricing_configuration.json",
+                       workers=None):
     """ Function PortfolioProcessor.
     Input Argument: filename (string). Name of the XML file containing the portfolio
-    Output: Nothing. A log file (log.txt) is produced alongside with an output XML
-    containing the priced portfolio.
+                    snapshot_name (string, optional). Name of a snapshot of precomputed grids and
+                    pdf weights (see GridSnapshot) to be memory-mapped before pricing
+                    log_name (string, optional). Name of the log file
+                    pricing_configuration (dictionary, optional). An already loaded pricing configuration:
+                    if None, it is read from pricing_configuration.json
+                    output_name (string, optional). Name of the output XML containing the priced portfolio
+                    verbose (boolean, optional). If True every priced deal is printed
+                    checkpoint_name (string, optional). Name of a checkpoint file (see CheckpointStore):
+                    priced deals are saved in it and, when the same run is restarted, they are not priced again
+                    checkpoint_batch (int, optional). Number of priced deals saved at once in the checkpoint
+                    pricing_configuration_name (string, optional). Name of the JSON pricing configuration, e.g. a
+                    routing table written by RoutingTuner (not used if pricing_configuration is given)
+                    workers (int, optional). If given, deals are priced in batches (see get_pricing_batches) by a
+                    pool of as many threads sharing the cached grids and pdf weights: the numpy kernel of a batch
+                    releases the GIL. With 1 the batches are priced by the calling thread (the serial reference
+                    of the pool). If None, deals are priced serially, one by one
+    Output: The list of deals (priced deals have a price attribute). A log file is produced alongside
+    with an output XML containing the priced portfolio (if output_name is given).
     """
 
     #STEP 0: PRELIMINARIES    
     assert isinstance(filename, str), "filename must be a string"
-    log_name = "log.txt"
     
     log_header = "PortfolioProcessor LOG: " + filename + " - " + datetime.datetime.now().isoformat() + "\n"
     with open(log_name, mode="w", encoding="utf-8") as f:
@@ -35,26 +60,13 @@ def PortfolioProcessor(filename):
     with open(log_name, mode="a", encoding="utf-8") as f:
         f.write(log_settings)
 
-    # Default pricing configuration
-    pricing_configuration = get_default_pricing_configuration()
-
     # Getting pricing configuration
-    config_file_name = "pricing_configuration.json"
-    log_pricing_configuration = "\n\nLoading Pricing Configuration file: " +  config_file_name +"\n"
     with open(log_name, mode="a", encoding="utf-8") as f:
-        f.write(log_pricing_configuration)
-        try:
-            with open(config_file_name, "r", encoding="utf-8") as json_pr_config:
-                pricing_configuration = json.load(json_pr_config)
-                f.write("Pricing Configuration loaded successfully: \n")
-                f.write(str(pricing_configuration) + "\n")
-        except ValueError as verr:
-            f.write("A ValueError occurred while reading Pricing Configuration file: " +  str(verr.args)+"\n")
-            f.write("Applying default settings\n")
-        except:
-            f.write("A problem occurred while reading Pricing Configuration file: " +  config_file_name +"\n")
-            f.write("Applying default settings\n")
-        f.write("\n")
+        if pricing_configuration is None:
+            pricing_configuration = load_pricing_configuration(pricing_configuration_name, f)
+        else:
+            f.write("\n\nPricing Configuration provided by the caller: \n")
+            f.write(str(pricing_configuration) + "\n\n")
     
 
     # XML Parsing
@@ -65,7 +77,7 @@ def PortfolioProcessor(filename):
             f.write("A FileNotFoundError occurred while parsing file: " +  filename +"\n")
             f.write("Details: " +  str(ferr.args)+"\n Exiting Portfolio Processor\n")
             return
-        except xml.etree.ParseError as xerr: #If the XML is not well-formed an "xml.etree.ParseError" is launched
+        except etree.ParseError as xerr: #If the XML is not well-formed an "xml.etree.ParseError" is launched
             f.write("A xml.etree.ParseError occurred while parsing file: " +  filename +"\n")
             f.write("Details: " +  str(xerr.args)+"\n Exiting Portfolio Processor\n")
             return
@@ -186,21 +198,239 @@ def PortfolioProcessor(filename):
 
     #STEP 2: BEGINNING OF PRICING OPERATION
     with open(log_name, mode="a", encoding="utf-8") as f:
+        if snapshot_name is not None:
+            f.write("\nLoading snapshot: " + snapshot_name + "\n")
+            try:
+                n_tables = GridSnapshot.load_snapshot(snapshot_name, settings)
+                if n_tables:
+                    f.write("%d precomputed tables loaded\n" % n_tables)
+                else:
+                    f.write("Snapshot is stale (other settings or engine version): tables will be rebuilt\n")
+            except (OSError, ValueError) as serr:
+                f.write("A problem occurred while loading snapshot: " + str(serr.args) + "\n")
+                f.write("Tables will be rebuilt\n")
+
+        checkpoint = None
+        already_priced = dict()
+        if checkpoint_name is not None:
+            f.write("\nOpening checkpoint: " + checkpoint_name + "\n")
+            try:
+                checkpoint = CheckpointStore.CheckpointStore(checkpoint_name,
+                                                             CheckpointStore.run_key(filename, settings, pricing_configuration),
+                                                             checkpoint_batch)
+                already_priced = checkpoint.priced()
+                f.write("%d deals already priced will be skipped\n" % len(already_priced))
+            except (OSError, sqlite3.Error) as cerr:
+                f.write("A problem occurred while opening checkpoint: " + str(cerr.args) + "\n")
+                f.write("Pricing without checkpoint\n")
+                checkpoint = None
+                already_priced = dict()
+
         f.write("\nBeginning pricing operations: \n")
         
-        for deal in portfolio:
+        def price(deal):
+            pricing_method = None
+            try:
+                pricing_method, deal_settings = get_pricing_route(pricing_configuration, deal, settings)
+                DealDealer.deal_pricer(deal, pricing_method, deal_settings)
+                return pricing_method, True
+            except Exception: # an interruption (e.g. KeyboardInterrupt) stops the run: the checkpoint keeps what is done
+                return pricing_method, False
+
+        def price_batch(batch):
+            # runs in a worker thread: only the deals of the batch are modified
+            pricing_method, deal_settings, positioned_deals = batch
+            if pricing_method is None: # no route: price() logs the problem
+                return {position: price(deal) for position, deal in positioned_deals}
             try:
-                f.write("\nDeal: " + str(deal) + "\n")
-                pricing_method = pricing_configuration[deal.type]["model"][deal.model.name]
-                f.write("Pricing Method: " + pricing_method + " \n")
-                DealDealer.deal_pricer(deal, pricing_method, settings)
-                f.write("\nDeal priced successfully. Price = %f \n" % deal.price)
-            except: ## Exception operation should be done better (not enough info for debugging: but I'm too much in a hurry
-                f.write("A problem occurred while pricing deal " + str(deal) +"\n")
-            print(deal)
+                DealDealer.batch_pricer([deal for position, deal in positioned_deals], pricing_method, deal_settings)
+                return {position: (pricing_method, True) for position, deal in positioned_deals}
+            except Exception: # one deal spoils the batch: they are priced one by one
+                return {position: price(deal) for position, deal in positioned_deals}
+
+        executor = None
+        try:
+            to_price = list()
+            for position, deal in enumerate(portfolio):
+                if (position, deal.ID) in already_priced:
+                    deal.price = already_priced[(position, deal.ID)]
+                    f.write("\nDeal " + deal.ID + " restored from checkpoint. Price = %f \n" % deal.price)
+                else:
+                    to_price.append((position, deal))
+
+            descriptions = dict()
+            results = dict()
+            logged = 0
+
+            def log_results():
+                # the log is written in portfolio order whatever the execution mode
+                nonlocal logged, checkpoint
+                while logged < len(to_price) and to_price[logged][0] in results:
+                    position, deal = to_price[logged]
+                    pricing_method, priced = results.pop(position)
+                    description = descriptions.pop(position)
+                    logged += 1
+                    f.write("\nDeal: " + description + "\n")
+                    if pricing_method is not None:
+                        f.write("Pricing Method: " + pricing_method + " \n")
+                    if priced:
+                        f.write("\nDeal priced successfully. Price = %f \n" % deal.price)
+                        if checkpoint is not None:
+                            try:
+                                checkpoint.add(position, deal.ID, deal.price)
+                            except sqlite3.Error as cerr:
+                                f.write("A problem occurred while writing checkpoint: " + str(cerr.args) + "\n")
+                                f.write("Pricing without checkpoint\n")
+                                checkpoint = None
+                    else: ## Exception operation should be done better (not enough info for debugging: but I'm too much in a hurry
+                        f.write("A problem occurred while pricing deal " + description +"\n")
+                    if verbose:
+                        print(deal)
+
+            if workers is not None and workers>=1:
+                f.write("Pricing in batches on %d thread(s)\n" % workers)
+                if PricingMethods.numpy is None:
+                    f.write("Warning: numpy is not available, vector_eval falls back to grid_eval "
+                            "and the pricing threads will not run in parallel\n")
+                else:
+                    f.write("grid_eval routes are priced with vector_eval (same trapezoidal rule, numpy kernels)\n")
+                batches = get_pricing_batches(pricing_configuration, to_price, settings, workers)
+                f.write("%d deals in %d batches\n" % (len(to_price), len(batches)))
+                if workers==1: # the batches are priced by the calling thread
+                    for batch in batches:
+                        descriptions.update({position: str(deal) for position, deal in batch[2]})
+                        results.update(price_batch(batch))
+                        log_results()
+                else:
+                    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+                    futures = list()
+                    for batch in batches:
+                        # the descriptions are taken before the deals are priced (and while other batches are)
+                        descriptions.update({position: str(deal) for position, deal in batch[2]})
+                        futures.append(executor.submit(price_batch, batch))
+                    for future in concurrent.futures.as_completed(futures):
+                        results.update(future.result())
+                        log_results()
+            else:
+                for position, deal in to_price:
+                    descriptions[position] = str(deal)
+                    results[position] = price(deal)
+                    log_results()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            # whatever happens, the last (incomplete) batch is saved
+            if checkpoint is not None:
+                try:
+                    checkpoint.close()
+                except sqlite3.Error as cerr:
+                    f.write("A problem occurred while closing checkpoint: " + str(cerr.args) + "\n")
+
+    if output_name is not None:
+        write_priced_portfolio(portfolio, filename, output_name)
+
+    if verbose:
+        print("\n \n ***** DONE ***** \n \n ")
+
+    return portfolio
 
 
-    print("\n \n ***** DONE ***** \n \n ")
+
+def load_pricing_configuration(config_file_name, f):
+    """ Function load_pricing_configuration.
+    Input Argument: config_file_name (string). Name of the JSON pricing configuration
+                    f (an open text file). The log
+    Output: the pricing configuration (the default one if the file cannot be read)
+    """
+    # Default pricing configuration
+    pricing_configuration = get_default_pricing_configuration()
+
+    f.write("\n\nLoading Pricing Configuration file: " +  config_file_name +"\n")
+    try:
+        with open(config_file_name, "r", encoding="utf-8") as json_pr_config:
+            pricing_configuration = json.load(json_pr_config)
+            f.write("Pricing Configuration loaded successfully: \n")
+            f.write(str(pricing_configuration) + "\n")
+    except ValueError as verr:
+        f.write("A ValueError occurred while reading Pricing Configuration file: " +  str(verr.args)+"\n")
+        f.write("Applying default settings\n")
+    except:
+        f.write("A problem occurred while reading Pricing Configuration file: " +  config_file_name +"\n")
+        f.write("Applying default settings\n")
+    f.write("\n")
+
+    return pricing_configuration
+
+
+
+def get_pricing_route(pricing_configuration, deal, settings):
+    """ Function get_pricing_route.
+    Input Argument: pricing_configuration (dictionary). The pricing configuration
+                    deal (a payoff). A deal loaded by PortfolioProcessor
+                    settings (dictionary). The settings of the portfolio
+    Output: the name of the pricing method and the settings to be used for the deal.
+    A model entry of the configuration is either the name of a method or a dictionary
+    {"method": name, "settings": settings} (e.g. in a routing table written by RoutingTuner):
+    in the second case its settings (e.g. only x_step) replace the corresponding ones of the portfolio.
+    """
+    route = pricing_configuration[deal.type]["model"][deal.model.name]
+    if isinstance(route, dict):
+        deal_settings = dict(settings)
+        deal_settings.update(route.get("settings", dict()))
+        return route["method"], deal_settings
+    return route, settings
+
+
+
+def get_pricing_batches(pricing_configuration, positioned_deals, settings, workers=1, batch_size=BATCH_SIZE):
+    """ Function get_pricing_batches.
+    Input Argument: pricing_configuration (dictionary). The pricing configuration
+                    positioned_deals (list). (position in the portfolio, deal) pairs
+                    settings (dictionary). The settings of the portfolio
+                    workers (int, optional). Number of pricing threads: a large group is split in at least
+                    as many batches
+                    batch_size (int, optional). Largest number of deals in a batch
+    Output: a list of (pricing method, settings, list of (position, deal)) batches. The deals of a batch have the
+    same type, model, pricing method and settings, so that DealDealer.batch_pricer can price them at once.
+    When numpy is available grid_eval routes become vector_eval ones (the same trapezoidal rule, evaluated
+    with numpy). Deals without a route are put in batches of their own with None as pricing method.
+    """
+    groups = dict()
+    batches = list()
+    for position, deal in positioned_deals:
+        try:
+            pricing_method, deal_settings = get_pricing_route(pricing_configuration, deal, settings)
+        except (KeyError, TypeError):
+            batches.append((None, settings, [(position, deal)]))
+            continue
+        if pricing_method=="grid_eval" and PricingMethods.numpy is not None:
+            pricing_method = "vector_eval"
+        key = (deal.type, deal.model, pricing_method, PricingMethods.settings_key(deal_settings))
+        groups.setdefault(key, (pricing_method, deal_settings, list()))[2].append((position, deal))
+
+    for pricing_method, deal_settings, group in groups.values():
+        size = max(1, min(batch_size, -(-len(group)//workers)))
+        for i in range(0, len(group), size):
+            batches.append((pricing_method, deal_settings, group[i:i+size]))
+    return batches
+
+
+
+def write_priced_portfolio(portfolio, filename, output_name):
+    """ Function write_priced_portfolio.
+    Input Argument: portfolio (list). The deals returned by PortfolioProcessor
+                    filename (string). Name of the XML file the portfolio comes from
+                    output_name (string). Name of the output XML
+    Output: Nothing. Deals which could not be priced are written without a price.
+    """
+    root = etree.Element("PricedPortfolio", source=filename)
+    for deal in portfolio:
+        payoff_raw_info = deal.type + ("Call" if deal.pars.Call_Put_Flag==1 else "Put")
+        node = etree.SubElement(root, "Payoff", type=payoff_raw_info)
+        etree.SubElement(node, "dealID").text = deal.ID
+        if hasattr(deal, "price"):
+            etree.SubElement(node, "price").text = repr(deal.price)
+    etree.ElementTree(root).write(output_name, encoding="UTF-8", xml_declaration=True)
 
 
 
@@ -242,5 +472,6 @@ def get_default_pricing_configuration():
     })
     return d
 
-filename = "DerivativeCatalog.xml"
-PortfolioProcessor(filename)
+if __name__=="__main__":
+    filename = "DerivativeCatalog.xml"
+    PortfolioProcessor(filename)
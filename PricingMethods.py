@@ -3,7 +3,149 @@
 # Date: April 2016
 
 import ModelFactory
+import array
+import collections
+import math
 import os
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # vector_eval falls back to grid_eval
+
+###########################################################################
+##                   PRECOMPUTED GRIDS AND PDF WEIGHTS                   ##
+###########################################################################
+
+# bumped whenever the way grids or weights are built changes (snapshots built by another version are stale)
+ENGINE_VERSION = "1"
+
+# grids and trapezoidal pdf weights only depend on the settings and on the model:
+# they are shared by every deal priced with the same settings/model
+_grids = dict()
+# least recently used first: beyond MAX_CACHED_TABLES the oldest built tables are dropped
+_weights = collections.OrderedDict()
+# keys of the tables installed by register_tables (e.g. a snapshot): they are never dropped
+_pinned = set()
+# read-only numpy views on the tables above (no copy), used by vector_eval
+_vectors = dict()
+# the caches are shared by the pricing threads
+_lock = threading.Lock()
+
+# largest number of built weight tables kept (a table holds one double per grid node)
+MAX_CACHED_TABLES = 256
+
+def settings_key(settings):
+    """ The (x_min, x_step, x_max) tuple identifying a grid.
+    """
+    return (float(settings["x_min"]), float(settings["x_step"]), float(settings["x_max"]))
+
+
+def build_grid(settings):
+    """ Nodes x_n of the integration grid described by settings (built at every call: see get_grid).
+    """
+    x_min, x_step, x_max = settings_key(settings)
+    assert x_min>=0, "x_min must be a positive number"
+    assert x_step>0, "x_step must be a positive number"
+    assert x_max>=x_min+x_step, "x_max must be greater than x_min+x_step"
+    x = array.array("d")
+    x_i = x_min
+    while x_i <= x_max: 
+        x.append(x_i)
+        x_i += x_step
+    return x
+
+
+def build_pdf_weights(model, settings, x):
+    """ Trapezoidal weights p(x_n)*h (halved at both ends) of a model on the grid x
+    (built at every call: see get_pdf_weights).
+    """
+    name, location, scale = model
+    pdf = ModelFactory.ModelFactory(name + "PDF", location, scale).pdf
+    x_step = settings_key(settings)[1]
+    w = array.array("d", [pdf(x_i)*x_step for x_i in x])
+    w[0] *= 0.5
+    w[-1] *= 0.5
+    return w
+
+
+def get_grid(settings):
+    """ Nodes x_n of the integration grid described by settings (built once per settings).
+    """
+    key = settings_key(settings)
+    x = _grids.get(key)
+    if x is None:
+        x = _grids.setdefault(key, build_grid(settings))
+    return x
+
+
+def get_pdf_weights(model, settings):
+    """ Trapezoidal weights p(x_n)*h (halved at both ends) of a model on the grid described by settings.
+
+    input: model: a (name, location, scale) tuple, e.g. payoff.model
+           settings: the grid settings
+    """
+    name, location, scale = model
+    key = (name, location, scale) + settings_key(settings)
+    with _lock:
+        w = _weights.get(key)
+        if w is not None:
+            _weights.move_to_end(key)
+    if w is None:
+        w = build_pdf_weights(model, settings, get_grid(settings))
+        with _lock:
+            w = _weights.setdefault(key, w)
+            _weights.move_to_end(key)
+            _evict_tables()
+    return w
+
+
+def _evict_tables():
+    # drop the least recently used tables beyond MAX_CACHED_TABLES (the pinned ones are not counted)
+    excess = len(_weights) - len(_pinned) - MAX_CACHED_TABLES
+    if excess > 0:
+        for key in [key for key in _weights if key not in _pinned][:excess]:
+            del _weights[key]
+            _vectors.pop(key, None)
+
+
+def register_tables(settings, grid, weights):
+    """ Install externally built tables (e.g. read from a snapshot) in the caches,
+    where they are kept whatever MAX_CACHED_TABLES (until clear_caches).
+
+    input: settings: the grid settings the tables have been built with
+           grid: a sequence of floats (the grid nodes)
+           weights: a dictionary {(name, location, scale): sequence of floats}
+    """
+    s_key = settings_key(settings)
+    with _lock:
+        _grids[s_key] = grid
+        _vectors.pop(s_key, None)
+        for model, w in weights.items():
+            assert len(w)==len(grid), "weights and grid must have the same length"
+            _weights[tuple(model) + s_key] = w
+            _pinned.add(tuple(model) + s_key)
+            _vectors.pop(tuple(model) + s_key, None)
+
+
+def cached_weights(settings):
+    """ Dictionary {(name, location, scale): weights} of every table currently cached for settings.
+    """
+    s_key = settings_key(settings)
+    with _lock:
+        return {key[:3]: w for key, w in _weights.items() if key[3:]==s_key}
+
+
+def clear_caches():
+    """ Drop every cached grid and weight table.
+    """
+    with _lock:
+        _grids.clear()
+        _weights.clear()
+        _pinned.clear()
+        _vectors.clear()
+
 
 ###########################################################################
 ##                   GRID EVALUATION FUNCTION                            ##
@@ -21,18 +163,126 @@ def grid_eval(payoff, settings):
     assert (isinstance(x_step,int) or isinstance(x_step, float)) and x_step>0, "x_step must be a positive number"
     assert (isinstance(x_max,int) or isinstance(x_max, float)) and x_max>=x_min+x_step, "x_max must be greater than x_min+x_step"
 
-    x = list()
-    x_i = x_min
-    while x_i <= x_max: 
-        x.append(x_i)
-        x_i += x_step
+    x = get_grid(settings)
+    w = get_pdf_weights(payoff.model, settings)
+
+    #trapezoidal integration rule (the 1/2 factors at both ends are already in the weights)
+    payoff_function = payoff.payoff_function
+    price = sum([payoff_function(x_i) * w_i for x_i, w_i in zip(x, w)])
+    return price
+
+    
+###########################################################################
+##                   VECTORIZED GRID EVALUATION FUNCTION                 ##
+###########################################################################
+
+# payoff functions on a whole numpy grid x, by payoff class name
+payoff_kernels = {
+    "PlainVanilla": lambda pars, x: numpy.maximum(pars.Call_Put_Flag*(x-pars.K), 0.0),
+    "Digital":      lambda pars, x: (pars.Call_Put_Flag*(x-pars.K) >= 0.0).astype(float),
+    "Barrier":      lambda pars, x: numpy.where(pars.Call_Put_Flag*(x-pars.B) < 0.0,
+                                                numpy.maximum(pars.Call_Put_Flag*(x-pars.K), 0.0), 0.0)
+}
+
+def _as_vector(key, table):
+    # read-only numpy view on a cached table (an array or a memory-mapped snapshot): nothing is copied
+    v = _vectors.get(key)
+    if v is None:
+        v = numpy.frombuffer(table, dtype=numpy.float64)
+        v.flags.writeable = False
+        with _lock:
+            if key in _weights or key in _grids: # not dropped in the meantime
+                v = _vectors.setdefault(key, v)
+    return v
+
+
+def vector_eval(payoff, settings):
+    """ Numerical approximation for payoff pricing: same trapezoidal rule as grid_eval, evaluated
+    with numpy on the whole grid at once. The numpy kernels release the GIL, so deals can be priced
+    by several threads sharing the same (read-only) grids and pdf weights.
+    If numpy is not available, or the payoff has no kernel, grid_eval is used.
+    """
+    kernel = payoff_kernels.get(type(payoff).__name__)
+    if numpy is None or kernel is None:
+        return grid_eval(payoff, settings)
+
+    x_min = settings["x_min"]
+    x_step = settings["x_step"]
+    x_max = settings["x_max"]
     
-    model_name = payoff.model.name + "PDF"
-    model = ModelFactory.ModelFactory(model_name, payoff.model.location, payoff.model.scale)
+    assert (isinstance(x_min,int) or isinstance(x_min, float)) and x_min>=0, "x_min must be a positive number"
+    assert (isinstance(x_step,int) or isinstance(x_step, float)) and x_step>0, "x_step must be a positive number"
+    assert (isinstance(x_max,int) or isinstance(x_max, float)) and x_max>=x_min+x_step, "x_max must be greater than x_min+x_step"
+
+    s_key = settings_key(settings)
+    m_key = tuple(payoff.model) + s_key
+    x = _as_vector(s_key, get_grid(settings))
+    w = _as_vector(m_key, get_pdf_weights(payoff.model, settings))
+
+    return float(numpy.dot(kernel(payoff.pars, x), w))
+
+
+def vector_eval_batch(payoffs, settings):
+    """ vector_eval of several payoffs of the same type on the same model at once: their parameters
+    are stacked in columns, so that the kernel gives a (payoffs x nodes) matrix, multiplied by the
+    pdf weights in a single numpy call (which releases the GIL for the whole batch).
+    If numpy is not available, or the payoffs have no kernel, grid_eval is used.
+
+    input: payoffs: a list of payoffs of the same class and with the same model
+           settings: the grid settings
+    output: the list of their prices
+    """
+    kernel = payoff_kernels.get(type(payoffs[0]).__name__)
+    if numpy is None or kernel is None:
+        return [grid_eval(payoff, settings) for payoff in payoffs]
+    assert all([type(payoff) is type(payoffs[0]) and payoff.model==payoffs[0].model for payoff in payoffs]), \
+        "payoffs of a batch must have the same type and model"
+
+    s_key = settings_key(settings)
+    m_key = tuple(payoffs[0].model) + s_key
+    x = _as_vector(s_key, get_grid(settings))
+    w = _as_vector(m_key, get_pdf_weights(payoffs[0].model, settings))
+
+    # the parameters namedtuple of the payoff class, holding a column per parameter instead of a number
+    pars = type(payoffs[0].pars)(*[numpy.array(column, dtype=float)[:, None] for column in zip(*[p.pars for p in payoffs])])
+    return numpy.dot(kernel(pars, x), w).tolist()
+
+    
+###########################################################################
+##                   SIMPSON EVALUATION FUNCTION                         ##
+###########################################################################
+
+def simpson_eval(payoff, settings):
+    """ Numerical approximation for payoff pricing: composite Simpson rule on [x_min, x_max], split at
+    the points where the payoff or the pdf is not smooth (strike, barrier, edges of the Uniform pdf).
+    Each piece is integrated with a step close to x_step: the error is O(x_step^4) instead of O(x_step^2)
+    (or O(x_step) for discontinuous payoffs) for grid_eval.
+    """
+
+    x_min = settings["x_min"]
+    x_step = settings["x_step"]
+    x_max = settings["x_max"]
+    
+    assert (isinstance(x_min,int) or isinstance(x_min, float)) and x_min>=0, "x_min must be a positive number"
+    assert (isinstance(x_step,int) or isinstance(x_step, float)) and x_step>0, "x_step must be a positive number"
+    assert (isinstance(x_max,int) or isinstance(x_max, float)) and x_max>=x_min+x_step, "x_max must be greater than x_min+x_step"
+
+    model = ModelFactory.ModelFactory(payoff.model.name + "PDF", payoff.model.location, payoff.model.scale)
+
+    breakpoints = [getattr(payoff.pars, name) for name in ("K", "B") if hasattr(payoff.pars, name)]
+    breakpoints += [getattr(model, name) for name in ("a", "b") if hasattr(model, name)]
+    nodes = sorted(set([x_min, x_max] + [b for b in breakpoints if x_min < b < x_max]))
 
-    #trapezoidal integration rule
-    integral = [payoff.payoff_function(x_i) * model.pdf(x_i)*x_step for x_i in x]
-    price = sum(integral)-0.5*(integral[0] + integral[-1])
+    payoff_function = payoff.payoff_function
+    pdf = model.pdf
+    price = 0.0
+    for lo, hi in zip(nodes[:-1], nodes[1:]):
+        n = 2*max(1, math.ceil((hi-lo)/(2*x_step)))
+        h = (hi-lo)/n
+        # both ends are evaluated slightly inside the piece: at a breakpoint the one-sided value is needed
+        eps = 1.e-9*h
+        y = [payoff_function(x_i)*pdf(x_i) for x_i in [lo+eps] + [lo+i*h for i in range(1,n)] + [hi-eps]]
+        price += (y[0] + y[-1] + 4*sum(y[1:-1:2]) + 2*sum(y[2:-1:2]))*h/3
     return price
 
     
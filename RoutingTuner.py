@@ -0,0 +1,202 @@
+
+# Author: Matteo L. BEDINI
+# Date: April 2016
+
+###########################################################################
+##                     AUTO-TUNING OF THE PRICING ROUTES                 ##
+###########################################################################
+
+# For every (payoff type, model) cell of a pricing configuration, every candidate engine is run
+# with every candidate grid on a deterministic set of representative deals. Each (engine, grid)
+# is measured in time and in accuracy (the largest absolute error against a high-precision
+# reference); the cheapest one meeting the accuracy target becomes the route of the cell.
+# The time is the steady-state cost per deal (caches warm): the grid and pdf weights are built
+# once per (model, settings) and shared by every deal of a run, so their cost is reported apart.
+# The routing table has the same layout as pricing_configuration.json, a model entry being
+# {"method": ..., "settings": {"x_step": ...}, ...} instead of a method name: only the step is tuned,
+# the domain [x_min, x_max] of a deal stays the one of its catalog (see PortfolioProcessor.get_pricing_route).
+# The accuracy of a route is only known on the deals it was tuned on: the representative deals, or
+# the deals of a portfolio. Every route records them (validated_on) together with the tuning domain.
+
+import copy
+import json
+import time
+
+import DealDealer
+import PayoffFactory
+import PortfolioProcessor
+import PricingMethods
+
+# engines whose accuracy is driven by the grid settings (the methods of the base configuration are added)
+ENGINES = ["grid_eval", "vector_eval", "simpson_eval"]
+
+# engines reading the cached grids and pdf weights of PricingMethods
+TABLE_ENGINES = ["grid_eval", "vector_eval"]
+
+# the reference: a fine Simpson rule on a domain much larger than the usual one
+REFERENCE_METHOD = "simpson_eval"
+REFERENCE_SETTINGS = {"x_min":1.e-6, "x_step":0.01, "x_max":500.0}
+
+DEFAULT_STEPS = [1.0, 0.5, 0.25, 0.1, 0.05, 0.025]
+
+# model name: (location, scale, strikes) of the representative deals
+MODEL_SAMPLES = {
+    "Gamma":     (9.0, 1.5, [10.0, 13.5, 17.0]),
+    "LogNormal": (2.0, 0.4, [6.0, 8.0, 10.0]),
+    "Uniform":   (10.0, 3.0, [8.0, 10.0, 12.0])
+}
+
+# distance between barrier and strike in the representative Barrier deals
+BARRIER_DISTANCE = 4.0
+
+def representative_deals(payoff_type, model_name):
+    """ function representative_deals
+
+    input: payoff_type: a payoff type of the pricing configuration (e.g. "PlainVanilla")
+           model_name: a model name (e.g. "Gamma")
+    output: a deterministic list of deals (calls and puts on a few strikes), empty if the model is not sampled
+    """
+    if model_name not in MODEL_SAMPLES:
+        return list()
+    location, scale, strikes = MODEL_SAMPLES[model_name]
+    deals = list()
+    for strike in strikes:
+        for call_put_flag in [1, -1]:
+            params = {"strike": strike, "call_put_flag": call_put_flag,
+                      "model_name": model_name, "model_location": location, "model_scale": scale}
+            if payoff_type == "Barrier":
+                params["barrier"] = strike + call_put_flag*BARRIER_DISTANCE
+            deal = PayoffFactory.PayoffFactory(payoff_type, params)
+            deal.type = payoff_type
+            deals.append(deal)
+    return deals
+
+
+def reference_prices(deals):
+    """ High-precision prices of deals (REFERENCE_METHOD with REFERENCE_SETTINGS).
+    """
+    pricing_fun = getattr(PricingMethods, REFERENCE_METHOD)
+    return [pricing_fun(deal, REFERENCE_SETTINGS) for deal in deals]
+
+
+def benchmark(deals, references, pricing_method, settings):
+    """ function benchmark
+
+    input: deals: a list of deals
+           references: their reference prices
+           pricing_method: the name of a pricing method
+           settings: the grid settings
+    output: a dictionary with the largest absolute error against the references, the average
+            pricing time per deal once the caches are warm (the steady-state cost, used for routing)
+            and the time spent building the grid and the pdf weights (build_seconds) if the
+            engine uses them. The caches of PricingMethods are filled, never emptied
+    """
+    # the build is timed on private tables: the cached ones (e.g. from a snapshot) are left alone
+    build_seconds = 0.0
+    if pricing_method in TABLE_ENGINES:
+        start = time.perf_counter()
+        x = PricingMethods.build_grid(settings)
+        for model in set([deal.model for deal in deals]):
+            PricingMethods.build_pdf_weights(model, settings, x)
+        build_seconds = time.perf_counter()-start
+
+    # priming pass (not timed): the missing tables are built and cached
+    for deal in deals:
+        DealDealer.deal_pricer(deal, pricing_method, settings)
+
+    start = time.perf_counter()
+    for deal in deals:
+        DealDealer.deal_pricer(deal, pricing_method, settings)
+    elapsed = time.perf_counter()-start
+    max_error = max([abs(deal.price-reference) for deal, reference in zip(deals, references)])
+    return {"max_error": max_error, "seconds_per_deal": elapsed/len(deals), "build_seconds": build_seconds}
+
+def candidate_settings(steps=DEFAULT_STEPS, x_min=0.01, x_max=100.01):
+    """ The grid settings tried for every engine: one per step.
+    """
+    return [{"x_min":x_min, "x_step":x_step, "x_max":x_max} for x_step in steps]
+
+
+def tune(base_configuration=None, accuracy_target=1.e-4, settings_list=None, portfolio=None):
+    """ function tune
+
+    input: base_configuration: the pricing configuration to be tuned (the default one if None)
+           accuracy_target: the largest absolute error allowed on the deals of a cell
+           settings_list: the candidate grid settings (see candidate_settings)
+           portfolio: a list of deals (e.g. returned by PortfolioProcessor): if given, every cell is
+                      tuned on its own deals instead of the representative deals
+    output: the routing table and a report {(payoff type, model name): list of benchmarks}.
+            When no candidate meets the target the most accurate one is chosen,
+            and its route is marked with "target_met": false
+    """
+    if base_configuration is None:
+        base_configuration = PortfolioProcessor.get_default_pricing_configuration()
+    if settings_list is None:
+        settings_list = candidate_settings()
+
+    routing_table = json.loads(json.dumps(base_configuration)) # deep copy
+    report = dict()
+    for payoff_type, payoff_configuration in base_configuration.items():
+        for model_name, route in payoff_configuration["model"].items():
+            if portfolio is None:
+                deals = representative_deals(payoff_type, model_name)
+            else:
+                deals = [copy.copy(deal) for deal in portfolio if deal.type==payoff_type and deal.model.name==model_name]
+            if not deals:
+                continue # nothing to measure: the base route is kept
+            references = reference_prices(deals)
+
+            base_method = route["method"] if isinstance(route, dict) else route
+            methods = ENGINES + [base_method] if base_method not in ENGINES else ENGINES
+            results = list()
+            for pricing_method in methods:
+                for settings in settings_list:
+                    try:
+                        result = benchmark(deals, references, pricing_method, settings)
+                    except Exception: # an engine which cannot price these deals is not a candidate
+                        continue
+                    result.update({"method": pricing_method, "settings": settings})
+                    results.append(result)
+            report[(payoff_type, model_name)] = results
+            if not results:
+                continue
+
+            feasible = [r for r in results if r["max_error"] <= accuracy_target]
+            best = (min(feasible, key=lambda r: r["seconds_per_deal"]) if feasible
+                    else min(results, key=lambda r: r["max_error"]))
+            routing_table[payoff_type]["model"][model_name] = {
+                "method": best["method"],
+                "settings": {"x_step": best["settings"]["x_step"]},
+                "validated_on": validated_on(deals, best["settings"]),
+                "max_error": best["max_error"],
+                "seconds_per_deal": best["seconds_per_deal"],
+                "build_seconds": best["build_seconds"],
+                "target_met": bool(feasible)
+            }
+
+    return routing_table, report
+
+
+def validated_on(deals, settings):
+    """ The deals a route was tuned on, as a dictionary: the tuning domain (x_min, x_max), the model
+    parameters [location, scale] and the strikes (and barriers) of the deals.
+    """
+    return {"x_min": settings["x_min"],
+            "x_max": settings["x_max"],
+            "models": [list(model) for model in sorted(set([(deal.model.location, deal.model.scale) for deal in deals]))],
+            "strikes": sorted(set([deal.pars.K for deal in deals])),
+            "barriers": sorted(set([deal.pars.B for deal in deals if hasattr(deal.pars, "B")]))}
+
+
+def write_routing_table(routing_table, routing_table_name):
+    """ Write a routing table as a JSON file usable as pricing configuration.
+    """
+    with open(routing_table_name, "w", encoding="utf-8") as f:
+        json.dump(routing_table, f, indent=4)
+
+
+if __name__=="__main__":
+    with open("tuning_log.txt", mode="w", encoding="utf-8") as f:
+        base_configuration = PortfolioProcessor.load_pricing_configuration("pricing_configuration.json", f)
+    routing_table, report = tune(base_configuration)
+    write_routing_table(routing_table, "tuned_pricing_configuration.json")
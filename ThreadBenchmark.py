@@ -0,0 +1,92 @@
+
+# Author: Matteo L. BEDINI
+# Date: April 2016
+
+###########################################################################
+##                   SERIAL VS THREAD-POOL PRICING BENCHMARK             ##
+###########################################################################
+
+# A synthetic catalog (every payoff type on every model, strikes spread around the model location)
+# is priced by PortfolioProcessor on thread pools of several sizes. Every run prices the same batches
+# with the same engine (see PortfolioProcessor.get_pricing_batches): the reference is workers=1, the
+# batches priced by the calling thread, so the speedups only measure the thread pool. The threads run
+# in parallel only with numpy and several cpus. The deal by deal pricing (workers=None) is shown apart.
+# The caches are primed by an untimed run first: every timed run finds the same tables.
+
+import json
+import os
+import tempfile
+import time
+
+import PortfolioProcessor
+import PricingMethods
+
+# model name: (location, scale) of the synthetic deals
+MODELS = {"Gamma": (9.0, 1.5), "LogNormal": (2.0, 0.4), "Uniform": (10.0, 3.0)}
+
+def write_catalog(catalog_name, n_deals, x_step=0.05):
+    """ function write_catalog
+
+    input: catalog_name: the name of the XML catalog to be written
+           n_deals: the number of deals
+           x_step: the grid step of its PricingSettings
+    output: Nothing. The deals cycle through payoff types, models and strikes
+    """
+    payoffs = list()
+    for i in range(n_deals):
+        payoff_type = ["PlainVanilla", "Digital", "Barrier"][i % 3]
+        model_name = sorted(MODELS)[(i//3) % 3]
+        location, scale = MODELS[model_name]
+        flavour = "Call" if (i//9) % 2==0 else "Put"
+        strike = 5.0 + (i % 101)*0.1
+        barrier = "\t\t<barrier>%g</barrier>\n" % (strike + (4.0 if flavour=="Call" else -4.0)) if payoff_type=="Barrier" else ""
+        payoffs.append('\t<Payoff type="%s%s">\n\t\t<dealID>%d</dealID>\n\t\t<strike>%g</strike>\n%s'
+                       '\t\t<model distribution="%s">\n\t\t\t<location>%g</location>\n\t\t\t<scale>%g</scale>\n\t\t</model>\n'
+                       '\t</Payoff>\n' % (payoff_type, flavour, i+1, strike, barrier, model_name, location, scale))
+    with open(catalog_name, mode="w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<DerivativeCatalog>\n')
+        f.write("\t<PricingSettings>\n\t\t<x0>0.01</x0>\n\t\t<xStep>%g</xStep>\n\t\t<xMAX>100.01</xMAX>\n\t</PricingSettings>\n" % x_step)
+        f.writelines(payoffs)
+        f.write("</DerivativeCatalog>\n")
+
+
+def grid_configuration():
+    """ The default pricing configuration with every cell on grid_eval (exact_eval depends on Excel).
+    """
+    return json.loads(json.dumps(PortfolioProcessor.get_default_pricing_configuration()).replace("exact_eval", "grid_eval"))
+
+
+def time_pricing(catalog_name, workers=None, pricing_configuration=None, repeat=1):
+    """ function time_pricing
+
+    input: catalog_name: the name of the XML catalog
+           workers: the number of pricing threads (1: batches priced by the calling thread, None: deal by deal)
+           pricing_configuration: the pricing configuration (grid_configuration() if None)
+           repeat: the number of runs (the fastest one is kept)
+    output: the elapsed time (s) of PortfolioProcessor and the list of prices
+    """
+    if pricing_configuration is None:
+        pricing_configuration = grid_configuration()
+    elapsed = float("inf")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            portfolio = PortfolioProcessor.PortfolioProcessor(catalog_name, log_name=os.path.join(tmp_dir, "log.txt"),
+                                                              pricing_configuration=pricing_configuration,
+                                                              verbose=False, workers=workers)
+            elapsed = min(elapsed, time.perf_counter()-start)
+    return elapsed, [deal.price for deal in portfolio]
+
+
+if __name__=="__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        catalog_name = os.path.join(tmp_dir, "benchmark_catalog.xml")
+        write_catalog(catalog_name, 3000)
+        time_pricing(catalog_name, 1) # priming run
+        serial_seconds, serial_prices = time_pricing(catalog_name, 1, repeat=3)
+        print("numpy available: %s, %s cpus" % (PricingMethods.numpy is not None, os.cpu_count()))
+        print("%-10s %10s %9s %12s" % ("workers", "seconds", "speedup", "max_diff"))
+        for workers in [1, 2, 4, 8, None]:
+            seconds, prices = (serial_seconds, serial_prices) if workers==1 else time_pricing(catalog_name, workers, repeat=3)
+            print("%-10s %10.3f %9.2f %12.3e" % ("deal/deal" if workers is None else workers, seconds, serial_seconds/seconds,
+                                                  max([abs(p-q) for p, q in zip(prices, serial_prices)])))